@@ -1,56 +1,454 @@
+import asyncio
+import json
+import os
+import random
 from contextvars import ContextVar
 from dataclasses import dataclass, field
 from functools import partial
 from logging import getLogger
-from typing import Any
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
 
 import yarl
-from aiohttp import ClientRequest, ClientResponse, ClientResponseError, ClientSession, RequestInfo
+from aiohttp import (
+    ClientError,
+    ClientRequest,
+    ClientResponse,
+    ClientResponseError,
+    ClientSession,
+    RequestInfo,
+)
 from aiohttp.client import _RequestContextManager as ClientRequestContextManager
-from fastapi import responses
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import responses, status
+from fastapi.encoders import jsonable_encoder
+from multidict import CIMultiDict, CIMultiDictProxy
+from pydantic import ValidationError, parse_raw_as
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from api_svc import context
+from api_svc.metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    CACHE_NOT_MODIFIED,
+    CACHE_REVALIDATIONS,
+    merge_server_timing,
+    record_span,
+)
+from api_svc.cache import (
+    NOT_MODIFIED_HEADERS,
+    CacheEntry,
+    MemoryCache,
+    cache_key,
+    is_cacheable,
+    parse_etags,
+    repr_digest,
+)
+from api_svc.transport import Address, ASGIConnector
 
 logger = getLogger("client")
 _session: ContextVar[ClientSession] = ContextVar("_session")
 
+# upstream headers relayed by `proxy`
+PROXY_HEADERS = ("content-type", "etag", "link")
+
+# request headers api-svc responses vary on; upstream Vary names headers api-svc adds itself, e.g. x-role,
+# and relaying it would have shared caches serve one user's response to all of them
+VARY = "accept, x-user"
+
+# headers unique to each request, which no response varies on; concurrent fetches share a flight regardless
+PER_REQUEST_HEADERS = {"x-correlation-id"}
+
+# fraction of proxied responses checked against the response model; PROXY_DEBUG checks all of them and
+# turns mismatches into 502 Bad Gateway
+PROXY_VALIDATE = float(os.getenv("PROXY_VALIDATE", "0.01"))
+PROXY_DEBUG = bool(os.getenv("PROXY_DEBUG"))
+
 
 class CacheResponse(ClientResponse):
-    pass
+    cache: MemoryCache
+    cache_entry: Optional[CacheEntry] = None
+    started: Optional[float] = None
+
+    async def start(self, connection):
+        await super().start(connection)
+
+        if self.started is not None:
+            record_span("upstream", perf_counter() - self.started)
+
+        # before a 304 is replaced with the cached response, along with its stale Server-Timing
+        if server_timing := self.headers.get("server-timing"):
+            merge_server_timing(server_timing, self.url.host or "upstream")
+
+        if self.status == 304 and self.cache_entry:
+            logger.info("FETCH %s %s", self.url, self.cache_entry.etag)
+            CACHE_HITS.inc()
+
+            headers = CIMultiDict(self.cache_entry.response_headers)
+            for name in NOT_MODIFIED_HEADERS:
+                if value := self.headers.get(name.decode()):
+                    headers[name.decode()] = value
+
+            self.status = 200
+            self.reason = "OK"
+            self._headers = CIMultiDictProxy(headers)
+            self._cache.pop("headers", None)  # invalidate @reify
+            self._body = bytes(self.cache_entry.body)
+
+            self.cache.store(
+                self.method,
+                self.url,
+                self.request_info.headers,
+                self.cache_entry.etag,
+                self.headers,
+                self._body,
+            )
+        else:
+            self.cache_entry = None
+
+        return self
+
+    async def read(self):
+        body = await super().read()
+
+        cacheable = is_cacheable(self.method, self.request_info.headers)
+
+        if self.cache_entry is None and self.status == 200 and cacheable:
+            CACHE_MISSES.inc()
+            if etag := self.headers.get("etag"):
+                logger.info("STORE %s %s", self.url, etag)
+                self.cache.store(self.method, self.url, self.request_info.headers, etag, self.headers, body)
+
+        # a write answered with `Prefer: return=representation` tells what a GET of `Content-Location` returns
+        elif self.status == 200 and not cacheable:
+            etag, location = self.headers.get("etag"), self.headers.get("content-location")
+            if etag and location:
+                url = self.url.join(yarl.URL(location))
+                logger.info("STORE %s %s", url, etag)
+                self.cache.store("GET", url, self.request_info.headers, etag, self.headers, body)
+
+        return body
 
 
 class CacheRequest(ClientRequest):
     async def send(self, conn):
         self.headers.update(context.current_headers())
-        return await super().send(conn)
+
+        entry = None
+        if is_cacheable(self.method, self.headers) and "if-none-match" not in self.headers:
+            if entry := self._session.cache.get(self.method, self.url, self.headers):
+                self.headers["if-none-match"] = entry.etag
+                CACHE_REVALIDATIONS.inc()
+
+        started = perf_counter()
+        response = await super().send(conn)
+        response.cache = self._session.cache
+        response.cache_entry = entry
+        response.started = started
+        return response
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, so that only the first one
+    does the work, and the others wait for its result or exception.
+
+    The work runs in a task of its own. If the caller which started it is
+    cancelled, the others still get the result.
+    """
+
+    def __init__(self):
+        self.flights: Dict[Hashable, asyncio.Future] = {}
+
+    def _land(self, key: Hashable, flight: asyncio.Future):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+        # don't complain about exceptions nobody waited for
+        if not flight.cancelled():
+            flight.exception()
+
+    def start(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        if (flight := self.flights.get(key)) is None:
+            flight = self.flights[key] = asyncio.ensure_future(work())
+            flight.add_done_callback(partial(self._land, key))
+        else:
+            logger.debug("JOIN %s", key[0][1])
+
+        return flight
+
+    async def __call__(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Any:
+        return await asyncio.shield(self.start(key, work))
 
 
 class CacheSession(ClientSession):
-    def __init__(self, *args, **kwargs):
+    ATTRS = ClientSession.ATTRS | {"cache", "flights"}
+
+    def __init__(self, *args, cache: MemoryCache, **kwargs):
         super().__init__(
             *args,
             request_class=CacheRequest,
             response_class=CacheResponse,
             **kwargs,
         )
+        self.cache = cache
+        self.flights = SingleFlight()
+
+
+class SessionPool:
+    """
+    App-lifetime `CacheSession`, so that connections to upstream services,
+    resolved addresses and the client cache survive between requests.
+
+    The session is opened on startup and closed on shutdown. Per-request state
+    is added by `CacheRequest` from the request context, so a single session
+    can be shared by all requests.
+    """
 
+    def __init__(
+        self,
+        cache: Optional[MemoryCache] = None,
+        limit: int = 100,
+        limit_per_host: int = 32,
+        # below uvicorn's default of 5s, so that the server never closes a connection we're about to reuse
+        keepalive_timeout: float = 4.0,
+        ttl_dns_cache: int = 300,
+        # upstream services called in-process rather than over TCP, by (host, port)
+        apps: Optional[Dict[Address, ASGIApp]] = None,
+    ):
+        self.cache = cache or MemoryCache()
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.apps = apps or {}
+        self.session: Optional[CacheSession] = None
+        self.lock = asyncio.Lock()
 
-class SessionMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return self.session
 
-    async def dispatch(self, request, call_next):
-        s = CacheSession(raise_for_status=True)
+        # without lifespan events, concurrent first requests all get here; all but one would leak a session
+        async with self.lock:
+            if self.session is None or self.session.closed:
+                connector = ASGIConnector(
+                    self.apps,
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                )
+                try:
+                    await connector.start()
+                except Exception:
+                    await connector.close()
+                    raise
+
+                self.session = CacheSession(cache=self.cache, connector=connector, raise_for_status=True)
+
+        return self.session
+
+    async def stop(self):
+        if self.session is not None and not self.session.closed:
+            connector = self.session.connector
+            await self.session.close()
+            if isinstance(connector, ASGIConnector):
+                await connector.stop()
+
+
+class SessionMiddleware:
+    def __init__(self, app: ASGIApp, pool: SessionPool):
+        self.app = app
+        self.pool = pool
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # opened on startup, unless the app is run without lifespan events
+        _session.set(await self.pool.start())
+
+        response_started = False
+
+        async def _send(message: Message):
+            nonlocal response_started
+            response_started |= message["type"] == "http.response.start"
+            await send(message)
 
         try:
-            _session.set(s)
-            return await call_next(request)
+            await self.app(scope, receive, _send)
         except ClientResponseError as ex:
-            return responses.JSONResponse(content=dict(message=ex.message), status_code=ex.status)
+            if response_started:
+                raise
+
+            response = responses.JSONResponse(content=dict(message=ex.message), status_code=ex.status)
+            await response(scope, receive, send)
+
+
+class UpstreamStreamingResponse(responses.StreamingResponse):
+    """
+    `StreamingResponse` relaying the body of an upstream response, which is
+    released once it's sent, or fails to be, even if its body was never read.
+    """
+
+    def __init__(self, upstream: ClientResponse, **kwargs: Any):
+        super().__init__(upstream.content.iter_any(), status_code=upstream.status, **kwargs)
+        self.upstream = upstream
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await super().__call__(scope, receive, send)
         finally:
-            if not s.closed:
-                await s.close()
+            self.upstream.release()
+
+
+async def stream(url: yarl.URL, **kwargs: Any) -> responses.StreamingResponse:
+    """
+    GET `url` and pass the upstream body to the caller chunk by chunk, as it
+    arrives, without reading it whole, with the same headers as `proxy`.
+    """
+    response = await ClientSession.get(_session.get(), url, **kwargs)
+
+    headers = {name: value for name in PROXY_HEADERS if (value := response.headers.get(name))}
+    headers["vary"] = VARY
+
+    return UpstreamStreamingResponse(response, headers=headers)
+
+
+@dataclass
+class Fetched:
+    status: int
+    headers: CIMultiDictProxy
+    body: bytes
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+    @classmethod
+    def from_cache(cls, entry: CacheEntry) -> "Fetched":
+        return cls(200, CIMultiDictProxy(CIMultiDict(entry.response_headers)), bytes(entry.body))
+
+
+async def fetch(url: yarl.URL, *, headers: Optional[Dict[str, str]] = None, **kwargs: Any) -> Fetched:
+    """
+    GET `url` and read the whole response. Concurrent fetches of the same
+    representation share a single upstream request.
+
+    Requests are the same if they agree on all headers the response varies
+    on. Until the first response for `url` tells which ones these are, they
+    have to agree on all headers, except for per-request ones such as the
+    correlation id.
+
+    Cached responses are reused according to their `Cache-Control`:
+     - within `max-age`, without asking upstream at all
+     - for `stale-while-revalidate` seconds more, while revalidating them in
+       the background
+     - for `stale-if-error` seconds more, when upstream fails
+    """
+    session = _session.get()
+    request_headers = CIMultiDict({**context.current_headers(), **(headers or {})})
+
+    if (vary := session.cache.vary.vary(url)) is None:
+        vary = tuple(sorted({name.lower() for name in request_headers} - PER_REQUEST_HEADERS))
+
+    key = (cache_key("GET", url, vary, request_headers), *sorted(kwargs.items()))
+
+    async def _fetch():
+        async with get(url, headers=request_headers, **kwargs) as response:
+            return Fetched(response.status, response.headers, await response.read())
+
+    age, entry = 0.0, session.cache.get("GET", url, request_headers)
+    if entry is not None:
+        age = session.cache.age(entry) - entry.seconds("max-age")
+
+        if age < 0:
+            logger.info("FRESH %s %s", url, entry.etag)
+            CACHE_HITS.inc()
+            return Fetched.from_cache(entry)
+
+        if age < entry.seconds("stale-while-revalidate"):
+            logger.info("STALE %s %s", url, entry.etag)
+            CACHE_HITS.inc()
+            session.flights.start(key, _fetch)
+            return Fetched.from_cache(entry)
+
+    try:
+        response = await session.flights(key, _fetch)
+    except (ClientError, asyncio.TimeoutError) as ex:
+        if entry is None or age >= entry.seconds("stale-if-error"):
+            raise
+
+        # 4xx are answers, not failures
+        if isinstance(ex, ClientResponseError) and ex.status < 500:
+            raise
+
+        logger.warning("STALE %s %s: %s", url, entry.etag, ex)
+        CACHE_HITS.inc()
+        return Fetched.from_cache(entry)
+
+    if response.status >= 500 and entry is not None and age < entry.seconds("stale-if-error"):
+        logger.warning("STALE %s %s: %s", url, entry.etag, response.status)
+        CACHE_HITS.inc()
+        return Fetched.from_cache(entry)
+
+    return response
+
+
+def _matches(model: Any, body: bytes) -> bool:
+    try:
+        parsed = parse_raw_as(model, body)
+    except ValidationError as ex:
+        logger.warning("%s", ex)
+        return False
+
+    # validation ignores extra fields, but they'd still reach the caller
+    return jsonable_encoder(parsed) == json.loads(body)
+
+
+async def proxy(url: yarl.URL, model: Any, if_none_match: Optional[str] = None, **kwargs: Any):
+    """
+    GET `url` and relay the upstream body as-is, with a few of its headers and
+    api-svc's own `Vary`, instead of decoding it, validating it against
+    `model` and encoding it again. Meant for read-only views returning
+    upstream data unchanged.
+
+    The body still goes through the client cache, so it's revalidated with
+    ETags like any other response. If the caller already has the current
+    representation, as told by `if_none_match`, it gets `304 Not Modified`.
+    """
+    response = await fetch(url, **kwargs)
+    body = response.body
+    headers = {name: value for name in PROXY_HEADERS if (value := response.headers.get(name))}
+    headers["vary"] = VARY
+
+    if (PROXY_DEBUG or random.random() < PROXY_VALIDATE) and not _matches(model, body):
+        logger.error("Upstream response from %s doesn't match %s", url, model)
+        if PROXY_DEBUG:
+            return responses.JSONResponse(
+                content=dict(message="Invalid upstream response"),
+                status_code=status.HTTP_502_BAD_GATEWAY,
+            )
+
+    if not_modified_response := not_modified(if_none_match, headers):
+        return not_modified_response
+
+    return responses.Response(body, status_code=response.status, headers=headers)
+
+
+def not_modified(if_none_match: Optional[str], headers: Dict[str, str]) -> Optional[responses.Response]:
+    """
+    `304 Not Modified` with `headers`, if the caller already has the
+    representation with the ETag among them, as told by `if_none_match`.
+    """
+    if if_none_match and (etag := headers.get("etag")):
+        etags = parse_etags(if_none_match)
+        if "*" in etags or etag in etags:
+            CACHE_NOT_MODIFIED.inc()
+            headers = {name: value for name, value in headers.items() if name != "content-type"}
+            return responses.Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return None
 
 
 def get(url: yarl.URL, *, allow_redirects: bool = True, **kwargs: Any) -> ClientRequestContextManager:
@@ -71,6 +469,21 @@ def post(
     return ClientSession.post(_session.get(), url, data=data, **kwargs)
 
 
+def lookup(url: yarl.URL, query: Any, **kwargs: Any) -> ClientRequestContextManager:
+    """
+    POST `query` as JSON to a view which only looks things up, such as a
+    batch read. The request carries `Repr-Digest` of its body, so that the
+    response is cached and revalidated like a GET, keyed by the body too.
+    """
+    body = json.dumps(query, separators=(",", ":")).encode()
+    headers = {
+        **kwargs.pop("headers", {}),
+        "content-type": "application/json",
+        "repr-digest": repr_digest(body),
+    }
+    return ClientSession.post(_session.get(), url, data=body, headers=headers, **kwargs)
+
+
 def put(
     url: yarl.URL, *, allow_redirects: bool = True, data: Any = None, **kwargs: Any
 ) -> ClientRequestContextManager:
@@ -1,10 +1,15 @@
+import importlib
 import logging
 import logging.config
+import os
+from typing import Dict, Optional
 
-from fastapi import FastAPI, status
+from fastapi import FastAPI, Query, Request, responses, status
 from pydantic import BaseModel, validator
+from starlette.types import ASGIApp
 
-from api_svc import client, context, log_config, role, route, urls
+from api_svc import bus, cache, client, context, log_config, metrics, role, route, shm, transport, urls
+from api_svc.response import NDJSON, accepts_ndjson
 
 
 class CreateTodoEntry(BaseModel):
@@ -49,22 +54,86 @@ class ListTodoList(BaseModel):
     name: str
 
 
+# ask todo-svc to answer writes with the new representation, rather than redirect to it
+REPRESENTATION = "return=representation"
+
+
+def write_headers(request: Request, **headers: str) -> Dict[str, str]:
+    # preconditions of the caller are checked by todo-svc
+    if if_match := request.headers.get("if-match"):
+        headers["if-match"] = if_match
+
+    return headers
+
+
+def response_cache() -> cache.MemoryCache:
+    # every upstream request goes out unconditionally
+    if os.getenv("CLIENT_CACHE") == "off":
+        return cache.MemoryCache(max_entries=0)
+
+    # share entries between uvicorn workers, e.g. CACHE_SLAB=/dev/shm/api-svc
+    if path := os.getenv("CACHE_SLAB"):
+        return shm.SharedMemoryCache(shm.Slab(path))
+
+    return cache.MemoryCache()
+
+
+def upstream_apps() -> Dict[transport.Address, ASGIApp]:
+    # run todo-svc in this process instead of calling it over the network, e.g. TODO_SVC_ASGI=todo_svc:asgi
+    if spec := os.getenv("TODO_SVC_ASGI"):
+        module, _, name = spec.partition(":")
+        app = getattr(importlib.import_module(module), name or "asgi")
+        return {(urls.TODO_SVC.host, urls.TODO_SVC.port): app}
+
+    return {}
+
+
+def page(after: Optional[str], limit: Optional[int]) -> dict:
+    return {name: value for name, value in dict(after=after, limit=limit).items() if value is not None}
+
+
+async def get_page(request: Request, url, model):
+    if accepts_ndjson(request.headers):
+        return await client.stream(url, headers={"accept": NDJSON})
+
+    # both services serve pages under the same paths, so the Link header can be relayed as-is
+    return await client.proxy(url, model, request.headers.get("if-none-match"))
+
+
 def api_svc() -> FastAPI:
     logging.config.dictConfig(log_config.LOG_CONFIG)
 
+    pool = client.SessionPool(cache=response_cache(), apps=upstream_apps())
+    roles = role.RoleCache()
+
     app = FastAPI()
     app.router.route_class = route.LoggingRoute
     app.router.route_class.DELIMITER = True
 
-    app.add_middleware(role.RoleMiddleware)
-    app.add_middleware(client.SessionMiddleware)
+    app.add_middleware(role.RoleMiddleware, roles=roles)
+    app.add_middleware(client.SessionMiddleware, pool=pool)
     app.add_middleware(context.CorrelationIdMiddleware)
     app.add_middleware(context.RequestHeadersMiddleware)
+    app.add_middleware(metrics.RequestMetricsMiddleware)
+
+    app.on_event("startup")(pool.start)
+    app.on_event("shutdown")(pool.stop)
+
+    # todo-svc reaches api-svc replicas only via multicast, they don't connect to the database
+    if os.getenv("INVALIDATION_BUS") == "multicast":
+        invalidation_bus = bus.Bus(bus.MulticastTransport())
+        roles.attach(invalidation_bus)
+
+        app.on_event("startup")(invalidation_bus.start)
+        app.on_event("shutdown")(invalidation_bus.stop)
 
     @app.get("/lists", response_model=list[ListTodoList])
-    async def get_todo_lists():
-        async with client.get(urls.TODO_SVC / "lists") as response:
-            return await response.json()
+    async def get_todo_lists(
+        request: Request,
+        after: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1),
+    ):
+        return await get_page(request, urls.TODO_SVC / "lists" % page(after, limit), list[ListTodoList])
 
     @app.post("/lists", response_model=ListTodoList, status_code=status.HTTP_201_CREATED)
     async def post_todo_lists(create_todo_list: CreateTodoList):
@@ -85,24 +154,47 @@ def api_svc() -> FastAPI:
                     return await response.json()
 
     @app.get("/lists/{list_id}", response_model=TodoList)
-    async def get_todo_list(list_id: str):
-        async with client.get(urls.TODO_SVC / "lists" / list_id) as response:
-            return await response.json()
+    async def get_todo_list(list_id: str, request: Request, response: responses.Response):
+        # through the client cache, so that upstream max-age, stale-while-revalidate and stale-if-error apply
+        fetched = await client.fetch(urls.TODO_SVC / "lists" / list_id)
+
+        # The body is reshaped, but always the same way, so the upstream ETag identifies it just as well. It's
+        # also what todo-svc checks If-Match of writes against.
+        headers = {name: value for name in ("etag",) if (value := fetched.headers.get(name))}
+        headers["vary"] = client.VARY
+        if not_modified := client.not_modified(request.headers.get("if-none-match"), headers):
+            return not_modified
+
+        response.headers.update(headers)
+        return fetched.json()
 
     @app.patch("/lists/{list_id}", response_model=TodoList)
-    async def patch_todo_list(list_id: str, patch_todo_list: CreateTodoList):
-        async with client.patch(urls.TODO_SVC / "lists" / list_id, json=patch_todo_list.dict()) as response:
-            return await response.json()
+    async def patch_todo_list(
+        list_id: str, patch_todo_list: CreateTodoList, request: Request, response: responses.Response
+    ):
+        async with client.patch(
+            urls.TODO_SVC / "lists" / list_id,
+            json=patch_todo_list.dict(),
+            headers=write_headers(request, prefer=REPRESENTATION),
+        ) as patched:
+            # the same ETag the list view relays, ready for If-Match of the next write
+            if etag := patched.headers.get("etag"):
+                response.headers["etag"] = etag
+
+            return await patched.json()
 
     @app.delete("/lists/{list_id}", status_code=status.HTTP_204_NO_CONTENT)
-    async def delete_todo_list(list_id: str):
-        async with client.delete(urls.TODO_SVC / "lists" / list_id):
+    async def delete_todo_list(list_id: str, request: Request):
+        async with client.delete(urls.TODO_SVC / "lists" / list_id, headers=write_headers(request)):
             return None
 
     @app.get("/lists/{list_id}/collaborators", response_model=list[Collaborator])
-    async def get_collaborators(list_id: str):
-        async with client.get(urls.TODO_SVC / "lists" / list_id / "collaborators") as response:
-            return await response.json()
+    async def get_collaborators(list_id: str, request: Request):
+        return await client.proxy(
+            urls.TODO_SVC / "lists" / list_id / "collaborators",
+            list[Collaborator],
+            request.headers.get("if-none-match"),
+        )
 
     @app.patch("/lists/{list_id}/collaborators", response_model=list[Collaborator])
     async def patch_collaborators(list_id: str, create_collaborators: list[str]):
@@ -121,9 +213,14 @@ def api_svc() -> FastAPI:
             return await response.json()
 
     @app.get("/lists/{list_id}/entries", response_model=list[TodoEntry])
-    async def get_entries(list_id: str):
-        async with client.get(urls.TODO_SVC / "lists" / list_id / "entries") as response:
-            return await response.json()
+    async def get_entries(
+        list_id: str,
+        request: Request,
+        after: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1),
+    ):
+        url = urls.TODO_SVC / "lists" / list_id / "entries" % page(after, limit)
+        return await get_page(request, url, list[TodoEntry])
 
     @app.post(
         "/lists/{list_id}/entries",
@@ -137,29 +234,50 @@ def api_svc() -> FastAPI:
         ) as response:
             return await response.json()
 
-    @app.get("/lists/{list_id}/entries/{todo_entry_id}", response_model=TodoEntry)
-    async def get_todo_entry(list_id: str, todo_entry_id: str):
-        async with client.get(urls.TODO_SVC / "lists" / list_id / "entries" / todo_entry_id) as response:
+    @app.post("/lists/{list_id}/entries/lookup", response_model=list[TodoEntry])
+    async def lookup_entries(list_id: str, entry_ids: list[str]):
+        url = urls.TODO_SVC / "lists" / list_id / "entries" / "lookup"
+        async with client.lookup(url, entry_ids) as response:
             return await response.json()
 
+    @app.get("/lists/{list_id}/entries/{todo_entry_id}", response_model=TodoEntry)
+    async def get_todo_entry(list_id: str, todo_entry_id: str, request: Request):
+        return await client.proxy(
+            urls.TODO_SVC / "lists" / list_id / "entries" / todo_entry_id,
+            TodoEntry,
+            request.headers.get("if-none-match"),
+        )
+
     @app.patch("/lists/{list_id}/entries/{todo_entry_id}", response_model=TodoEntry)
-    async def patch_todo_entry(list_id: str, todo_entry_id: str, update_todo_entry: UpdateTodoEntry):
+    async def patch_todo_entry(
+        list_id: str, todo_entry_id: str, update_todo_entry: UpdateTodoEntry, request: Request
+    ):
         async with client.patch(
             urls.TODO_SVC / "lists" / list_id / "entries" / todo_entry_id,
             json=update_todo_entry.dict(),
+            headers=write_headers(request, prefer=REPRESENTATION),
         ) as response:
-            return await response.json()
+            # same body and ETag as the GET view relays
+            headers = {name: value for name in client.PROXY_HEADERS if (value := response.headers.get(name))}
+            return responses.Response(await response.read(), headers=headers)
 
     @app.delete(
         "/lists/{list_id}/entries/{todo_entry_id}",
         status_code=status.HTTP_204_NO_CONTENT,
     )
-    async def delete_todo_entry(list_id: str, todo_entry_id: str):
-        async with client.delete(urls.TODO_SVC / "lists" / list_id / "entries" / todo_entry_id):
+    async def delete_todo_entry(list_id: str, todo_entry_id: str, request: Request):
+        async with client.delete(
+            urls.TODO_SVC / "lists" / list_id / "entries" / todo_entry_id,
+            headers=write_headers(request),
+        ):
             return None
 
     @app.get("/health")
     async def get_health():
         return "OK"
 
+    @app.get("/metrics")
+    async def get_metrics():
+        return responses.Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
     return app
@@ -1,24 +1,148 @@
 import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from api_svc import client, context, urls
+from api_svc.cache import CACHEABLE_METHODS
+from api_svc.metrics import span
+from api_svc.signal import Signal
 
+# (list_id, email)
+RoleKey = Tuple[str, str]
 
-class RoleMiddleware(BaseHTTPMiddleware):
-    def _get_list_id(self, request):
-        if m := re.match(r"^/lists/(?P<list_id>[a-f0-9]+)", request.url.path):
+
+@dataclass
+class RoleEntry:
+    role: Optional[str]
+    expires: float
+    unsubscribe: List[Callable[[], None]] = field(default_factory=list)
+
+
+class RoleCache:
+    """
+    Remembers collaborators' roles, so that list-scoped requests don't need
+    an extra request to todo-svc every time.
+
+    Roles are trusted for `max_age` seconds, and unknown collaborators for
+    `negative_max_age` seconds. After that, the role is fetched again, which
+    usually costs just a `304 Not Modified`, since the client cache revalidates
+    it with an ETag.
+
+    Entries are dropped when a change to the list or its collaborators is
+    published on `lists` or `collaborators` signals. `RoleMiddleware` publishes
+    changes made through this process, and with an invalidation bus attached,
+    the signals also carry changes committed by todo-svc.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_age: float = 5.0, negative_max_age: float = 1.0):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.negative_max_age = negative_max_age
+
+        self.roles: OrderedDict[RoleKey, RoleEntry] = OrderedDict()
+        self.lists = Signal()
+        self.collaborators = Signal()
+
+    def get(self, list_id: str, email: str) -> Optional[RoleEntry]:
+        key = (list_id, email)
+
+        if (entry := self.roles.get(key)) is None:
+            return None
+
+        if entry.expires < time.monotonic():
+            self.drop(key)
+            return None
+
+        self.roles.move_to_end(key)
+        return entry
+
+    def put(self, list_id: str, email: str, role: Optional[str]):
+        key = (list_id, email)
+        self.drop(key)
+
+        max_age = self.max_age if role is not None else self.negative_max_age
+        self.roles[key] = entry = RoleEntry(role, time.monotonic() + max_age)
+
+        entry.unsubscribe.append(self.lists.subscribe(dict(list_id=list_id), partial(self.drop, key)))
+        entry.unsubscribe.append(
+            self.collaborators.subscribe(dict(list_id=list_id, email=email), partial(self.drop, key))
+        )
+
+        while len(self.roles) > self.max_entries:
+            self.drop(next(iter(self.roles)))
+
+    def drop(self, key: RoleKey):
+        if entry := self.roles.pop(key, None):
+            for unsubscribe in entry.unsubscribe:
+                unsubscribe()
+
+    def attach(self, bus):
+        bus.attach("lists", self.lists)
+        bus.attach("collaborators", self.collaborators)
+
+
+class RoleMiddleware:
+    def __init__(self, app: ASGIApp, roles: Optional[RoleCache] = None):
+        self.app = app
+        self.roles = roles or RoleCache()
+
+    def _get_list_id(self, path):
+        if m := re.match(r"^/lists/(?P<list_id>[a-f0-9]+)", path):
             return m.group("list_id")
 
-    async def dispatch(self, request, call_next):
-        if list_id := self._get_list_id(request):
+    def _changes_collaborators(self, method, path):
+        if method in CACHEABLE_METHODS:
+            return False
+
+        # deleting the list removes its collaborators as well
+        if method == "DELETE" and re.match(r"^/lists/[a-f0-9]+/?$", path):
+            return True
+
+        return bool(re.match(r"^/lists/[a-f0-9]+/collaborators", path))
+
+    async def _get_role(self, list_id, email) -> Optional[str]:
+        if entry := self.roles.get(list_id, email):
+            return entry.role
+
+        response = await client.fetch(
+            urls.TODO_SVC / "lists" / list_id / "collaborators" / email,
+            raise_for_status=False,
+        )
+        if response.status == 200:
+            role = response.json()["role"]
+        elif response.status == 404:
+            role = None
+        else:
+            return None
+
+        self.roles.put(list_id, email, role)
+        return role
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if list_id := self._get_list_id(scope["path"]):
             if email := context.current_headers().get("x-user"):
-                async with client.get(
-                    urls.TODO_SVC / "lists" / list_id / "collaborators" / email,
-                    raise_for_status=False,
-                ) as response:
-                    if response.status == 200:
-                        user = await response.json()
-                        context.update_headers(**{"x-role": user["role"]})
-
-        return await call_next(request)
+                with span("role"):
+                    role = await self._get_role(list_id, email)
+
+                if role:
+                    context.update_headers(**{"x-role": role})
+
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                # todo-svc relays the change to other replicas itself, so notify this one only
+                if self._changes_collaborators(scope["method"], scope["path"]):
+                    await self.roles.lists.dispatch(dict(list_id=list_id))
+
+            return
+
+        await self.app(scope, receive, send)
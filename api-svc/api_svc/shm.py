@@ -0,0 +1 @@
+../../common/shm.py
\ No newline at end of file
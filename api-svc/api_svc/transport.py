@@ -0,0 +1,202 @@
+import asyncio
+import contextvars
+from logging import getLogger
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+import h11
+from aiohttp import ClientRequest, ClientTimeout, TCPConnector
+from aiohttp.client_proto import ResponseHandler
+from starlette.types import ASGIApp, Message
+
+logger = getLogger("client")
+
+# (host, port) of an upstream service
+Address = Tuple[str, int]
+
+
+class ASGITransport(asyncio.Transport):
+    """
+    In-memory connection to an ASGI application. HTTP/1.1 written by the
+    client is parsed with h11 and dispatched to the application, and the
+    application's response is serialized back and fed to the client's
+    protocol, as if it came from a socket.
+
+    Going through HTTP keeps everything the client does on top of it, such as
+    conditional requests, redirects and `raise_for_status`, exactly as with a
+    real connection.
+    """
+
+    def __init__(self, app: ASGIApp, protocol: ResponseHandler, address: Address):
+        super().__init__()
+        self.app = app
+        self.protocol = protocol
+        self.address = address
+
+        self.connection = h11.Connection(h11.SERVER)
+        self.request: Optional[h11.Request] = None
+        self.body: List[bytes] = []
+        self.task: Optional[asyncio.Task] = None
+        self.closed = asyncio.Event()
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        if name in ("peername", "sockname"):
+            return self.address
+
+        return default
+
+    def is_closing(self) -> bool:
+        return self.closed.is_set()
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def write(self, data: bytes):
+        self.connection.receive_data(data)
+
+        while (event := self.connection.next_event()) not in (h11.NEED_DATA, h11.PAUSED):
+            if isinstance(event, h11.Request):
+                self.request, self.body = event, []
+            elif isinstance(event, h11.Data):
+                self.body.append(event.data)
+            elif isinstance(event, h11.EndOfMessage):
+                # the application runs in a context of its own, like on the other end of a socket
+                self.task = contextvars.Context().run(asyncio.create_task, self._respond())
+            elif isinstance(event, h11.ConnectionClosed):
+                break
+
+    def close(self):
+        if self.closed.is_set():
+            return
+
+        self.closed.set()
+        if self.task is not None and asyncio.current_task() is not self.task:
+            self.task.cancel()
+
+        asyncio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    abort = close
+
+    def _scope(self, request: h11.Request) -> Dict[str, Any]:
+        path, _, query = request.target.partition(b"?")
+
+        return dict(
+            type="http",
+            asgi=dict(version="3.0", spec_version="2.3"),
+            http_version="1.1",
+            method=request.method.decode(),
+            scheme="http",
+            path=unquote(path.decode("latin-1")),
+            raw_path=path,
+            query_string=query,
+            root_path="",
+            headers=list(request.headers),
+            client=("127.0.0.1", 0),
+            server=self.address,
+        )
+
+    async def _respond(self):
+        assert self.request is not None
+        body = b"".join(self.body)
+        received = False
+
+        async def receive() -> Message:
+            nonlocal received
+            if not received:
+                received = True
+                return dict(type="http.request", body=body, more_body=False)
+
+            await self.closed.wait()
+            return dict(type="http.disconnect")
+
+        async def send(message: Message):
+            if self.closed.is_set():
+                return
+
+            if message["type"] == "http.response.start":
+                response = h11.Response(status_code=message["status"], headers=message.get("headers", []))
+                self.protocol.data_received(self.connection.send(response))
+            elif message["type"] == "http.response.body":
+                if chunk := message.get("body", b""):
+                    self.protocol.data_received(self.connection.send(h11.Data(data=chunk)))
+                if not message.get("more_body"):
+                    self.protocol.data_received(self.connection.send(h11.EndOfMessage()))
+
+        try:
+            await self.app(self._scope(self.request), receive, send)
+        except Exception:
+            logger.exception("In-process request to %s:%d failed", *self.address)
+            if self.connection.our_state in (h11.IDLE, h11.SEND_RESPONSE):
+                error = h11.Response(status_code=500, headers=[(b"content-length", b"0")])
+                self.protocol.data_received(self.connection.send(error))
+                self.protocol.data_received(self.connection.send(h11.EndOfMessage()))
+
+        if self.connection.our_state is h11.DONE and self.connection.their_state is h11.DONE:
+            self.connection.start_next_cycle()
+        else:
+            self.close()
+
+
+class ASGIConnector(TCPConnector):
+    """
+    `TCPConnector` which connects to some upstream services in-process,
+    dispatching requests straight into their ASGI applications, and to all
+    others over TCP. Connections are pooled and kept alive either way.
+
+    Lifespan events of in-process applications are run by `start` and
+    `stop`, so that they get to run their startup hooks, e.g. migrations.
+    If any of them fails to start, so does the connector.
+    """
+
+    def __init__(self, apps: Dict[Address, ASGIApp], **kwargs: Any):
+        super().__init__(**kwargs)
+        self.apps = apps
+        self.lifespans: List[Tuple[asyncio.Queue, asyncio.Task]] = []
+
+    async def _create_connection(
+        self, req: ClientRequest, traces: List[Any], timeout: ClientTimeout
+    ) -> ResponseHandler:
+        address = (req.url.raw_host or "", req.url.port or 80)
+        if (app := self.apps.get(address)) is None:
+            return await super()._create_connection(req, traces, timeout)
+
+        protocol = ResponseHandler(loop=self._loop)
+        protocol.connection_made(ASGITransport(app, protocol, address))
+        return protocol
+
+    async def start(self):
+        for app in self.apps.values():
+            receive: asyncio.Queue = asyncio.Queue()
+            sent: asyncio.Queue = asyncio.Queue()
+
+            async def _lifespan(app=app, receive=receive, sent=sent):
+                try:
+                    await app(dict(type="lifespan", asgi=dict(version="3.0")), receive.get, sent.put)
+                except Exception:
+                    # lifespan isn't supported, see https://asgi.readthedocs.io/en/latest/specs/lifespan.html
+                    await sent.put(dict(type="lifespan.unsupported"))
+
+            task = asyncio.create_task(_lifespan())
+            await receive.put(dict(type="lifespan.startup"))
+
+            message = await sent.get()
+            if message["type"] == "lifespan.unsupported":
+                continue
+
+            if message["type"] == "lifespan.startup.failed":
+                await task
+                # don't leave applications started so far, nor this one, running half-started
+                await self.stop()
+                raise RuntimeError(f"In-process application failed to start: {message.get('message')}")
+
+            self.lifespans.append((receive, task))
+
+    async def stop(self):
+        for receive, task in self.lifespans:
+            await receive.put(dict(type="lifespan.shutdown"))
+            await task
+
+        self.lifespans.clear()
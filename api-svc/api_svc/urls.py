@@ -1,3 +1,6 @@
+import os
+
 from yarl import URL
 
-TODO_SVC = URL("http://todo-svc")
+# host, with an optional port, e.g. TODO_SVC=127.0.0.1:8001
+TODO_SVC = URL(f"http://{os.getenv('TODO_SVC', 'todo-svc')}")
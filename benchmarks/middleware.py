@@ -0,0 +1,139 @@
+"""
+Per-request overhead of the api-svc middleware stack, with the pure ASGI
+middlewares and with equivalent `BaseHTTPMiddleware` ones, which is how the
+stack used to be built.
+
+Requests are driven straight through the ASGI interface, so that neither
+the network nor the server is measured.
+
+    PYTHONPATH=api-svc python benchmarks/middleware.py
+"""
+import asyncio
+import time
+from secrets import token_hex
+
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from api_svc import client, context, role
+
+REQUESTS = 10000
+
+
+class LegacyRequestHeadersMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        context._headers.set(
+            {
+                name: value
+                for name, value in request.headers.items()
+                if name in context.RequestHeadersMiddleware.HEADERS
+            }
+        )
+        return await call_next(request)
+
+
+class LegacyCorrelationIdMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        context.update_headers(**{"x-correlation-id": token_hex(3)})
+        return await call_next(request)
+
+
+class LegacySessionMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, pool):
+        super().__init__(app)
+        self.pool = pool
+
+    async def dispatch(self, request, call_next):
+        client._session.set(await self.pool.start())
+        return await call_next(request)
+
+
+class LegacyRoleMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        role.RoleMiddleware._get_list_id(None, request.url.path)
+        return await call_next(request)
+
+
+def app(*middlewares) -> FastAPI:
+    pool = client.SessionPool()
+
+    app = FastAPI()
+    for middleware in middlewares:
+        app.add_middleware(middleware, **(dict(pool=pool) if "Session" in middleware.__name__ else {}))
+
+    @app.get("/lists")
+    async def get_todo_lists():
+        return []
+
+    return app
+
+
+async def measure(asgi) -> float:
+    scope = dict(
+        type="http",
+        asgi=dict(version="3.0"),
+        http_version="1.1",
+        method="GET",
+        scheme="http",
+        path="/lists",
+        raw_path=b"/lists",
+        query_string=b"",
+        root_path="",
+        headers=[(b"host", b"api-svc"), (b"x-user", b"test@user.com")],
+        client=("127.0.0.1", 1234),
+        server=("127.0.0.1", 80),
+    )
+
+    disconnected = asyncio.Event()
+
+    def request():
+        messages = [dict(type="http.request", body=b"", more_body=False)]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+
+            # the client never disconnects
+            await disconnected.wait()
+
+        return receive
+
+    async def send(message):
+        pass
+
+    for _ in range(REQUESTS // 10):
+        await asgi(dict(scope), request(), send)
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        await asgi(dict(scope), request(), send)
+
+    return (time.perf_counter() - start) / REQUESTS * 1e6
+
+
+async def main():
+    bare = await measure(app())
+    pure = await measure(
+        app(
+            role.RoleMiddleware,
+            client.SessionMiddleware,
+            context.CorrelationIdMiddleware,
+            context.RequestHeadersMiddleware,
+        )
+    )
+    legacy = await measure(
+        app(
+            LegacyRoleMiddleware,
+            LegacySessionMiddleware,
+            LegacyCorrelationIdMiddleware,
+            LegacyRequestHeadersMiddleware,
+        )
+    )
+
+    print(f"no middleware:      {bare:8.1f} us/request")
+    print(f"BaseHTTPMiddleware: {legacy:8.1f} us/request, +{legacy - bare:.1f} us")
+    print(f"pure ASGI:          {pure:8.1f} us/request, +{pure - bare:.1f} us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
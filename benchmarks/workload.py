@@ -0,0 +1,396 @@
+"""
+Throughput, latency, DB queries per request and cache hit rates of a mixed
+read/write workload, with caching tiers switched on and off:
+
+ - uncached: neither todo-svc keeps ETags, nor api-svc keeps responses
+ - etag: todo-svc answers conditional requests from its cache
+ - etag+client: api-svc revalidates its cached responses, too
+ - etag+client-invalidation: the same, but writes don't drop cached
+   responses, which are served stale until they expire; what invalidation
+   costs, rather than a configuration to deploy
+ - etag+client+bus: several todo-svc workers relay invalidations to each
+   other over multicast
+
+Both services run in this process under uvicorn. Configurations with the
+bus run `--workers` todo-svc workers: one in this process, and the others in
+processes of their own, listening on the same port with SO_REUSEPORT, so
+that the kernel spreads api-svc connections over them. todo-svc talks to
+Postgres configured the same way as in docker-compose, via DB_HOST, DB_USER,
+DB_PASSWORD and DB_NAME. todo-svc relies on Postgres for RETURNING, arrays,
+ON CONFLICT and LISTEN/NOTIFY, so there's no SQLite fallback; a throwaway
+instance will do:
+
+    docker run --rm -p 5432:5432 -e POSTGRES_PASSWORD=postgres -e POSTGRES_DB=todo postgres:11.5
+
+Each configuration runs in a fresh process, so that caches, subscriptions
+and metrics start empty, and with the same seed, so that every run makes
+the same random choices.
+
+Results are written as JSON, for comparing runs over time:
+
+    PYTHONPATH=todo-svc:api-svc python benchmarks/workload.py --output workload.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import socket
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from queue import Empty
+from typing import Any, Dict, List, Tuple
+
+CONFIGS = {
+    "uncached": dict(RESPONSE_CACHE="off", CLIENT_CACHE="off"),
+    "etag": dict(CLIENT_CACHE="off"),
+    "etag+client": dict(),
+    "etag+client-invalidation": dict(CACHE_INVALIDATION="off"),
+    "etag+client+bus": dict(INVALIDATION_BUS="multicast"),
+}
+
+# operation: weight
+OPERATIONS = {
+    "get_lists": 20,
+    "get_list": 30,
+    "get_entries": 20,
+    "get_entry": 20,
+    "post_entry": 4,
+    "patch_entry": 4,
+    "patch_list": 2,
+}
+
+
+def percentile(latencies: List[float], p: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+
+    return statistics.quantiles(latencies, n=100)[p - 1]
+
+
+def summary(latencies: List[float]) -> Dict[str, Any]:
+    return dict(
+        requests=len(latencies),
+        p50_ms=round(percentile(latencies, 50) * 1000, 3),
+        p99_ms=round(percentile(latencies, 99) * 1000, 3),
+    )
+
+
+class Workload:
+    """
+    Users share lists with each other, and read them much more often than
+    they write to them. Like browsers, users keep ETags of what they've seen
+    and send `If-None-Match`.
+    """
+
+    def __init__(self, session, url, args):
+        self.session = session
+        self.url = url
+        self.args = args
+        self.random = random.Random(args.seed)
+
+        # unique per run, so that runs against the same database don't see each other's lists
+        run = f"{time.time():.0f}"
+        self.users = [f"user{i}@{run}.bench" for i in range(args.users)]
+        self.lists: Dict[str, List[str]] = defaultdict(list)
+        self.entries: Dict[str, List[str]] = defaultdict(list)
+        self.etags: Dict[Tuple[str, str], str] = {}
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors = 0
+
+    async def request(self, user: str, method: str, path: str, **kwargs) -> Any:
+        headers = {"x-user": user}
+        if method == "GET" and (etag := self.etags.get((user, path))):
+            headers["if-none-match"] = etag
+
+        async with self.session.request(method, self.url + path, headers=headers, **kwargs) as response:
+            body = await response.read()
+
+            if response.status >= 400:
+                self.errors += 1
+                return None
+
+            if method == "GET" and (etag := response.headers.get("etag")):
+                self.etags[(user, path)] = etag
+
+            return json.loads(body) if body else None
+
+    async def setup(self):
+        for _ in range(self.args.lists):
+            owner = self.random.choice(self.users)
+            todo_list = await self.request(owner, "POST", "/lists", json=dict(name="bench"))
+            list_id = todo_list["list_id"]
+
+            others = [user for user in self.users if user != owner]
+            collaborators = self.random.sample(others, min(self.args.share, len(others)))
+            await self.request(owner, "PATCH", f"/lists/{list_id}/collaborators", json=collaborators)
+
+            for user in (owner, *collaborators):
+                self.lists[user].append(list_id)
+
+            for _ in range(self.args.entries):
+                path = f"/lists/{list_id}/entries"
+                entry = await self.request(owner, "POST", path, json=dict(text="bench"))
+                self.entries[list_id].append(entry["entry_id"])
+
+    async def operation(self, rng: random.Random, user: str, operation: str):
+        list_id = rng.choice(self.lists[user])
+
+        if not self.entries[list_id] and operation in ("get_entry", "patch_entry"):
+            operation = "post_entry"
+        entry_id = rng.choice(self.entries[list_id]) if self.entries[list_id] else None
+
+        if operation == "get_lists":
+            await self.request(user, "GET", "/lists")
+        elif operation == "get_list":
+            await self.request(user, "GET", f"/lists/{list_id}")
+        elif operation == "get_entries":
+            await self.request(user, "GET", f"/lists/{list_id}/entries")
+        elif operation == "get_entry":
+            await self.request(user, "GET", f"/lists/{list_id}/entries/{entry_id}")
+        elif operation == "post_entry":
+            entry = await self.request(user, "POST", f"/lists/{list_id}/entries", json=dict(text="new"))
+            if entry:
+                self.entries[list_id].append(entry["entry_id"])
+        elif operation == "patch_entry":
+            path = f"/lists/{list_id}/entries/{entry_id}"
+            await self.request(user, "PATCH", path, json=dict(text=str(rng.random())))
+        elif operation == "patch_list":
+            await self.request(user, "PATCH", f"/lists/{list_id}", json=dict(name=str(rng.random())))
+
+    async def worker(self, requests: int, seed: int):
+        rng = random.Random(seed)
+        users = [user for user in self.users if self.lists[user]]
+        operations, weights = zip(*OPERATIONS.items())
+
+        for _ in range(requests):
+            user = rng.choice(users)
+            (operation,) = rng.choices(operations, weights)
+
+            start = time.perf_counter()
+            await self.operation(rng, user, operation)
+            self.latencies[operation].append(time.perf_counter() - start)
+
+
+def _counter(metric) -> float:
+    return sum(metric.values.values())
+
+
+def _hit_rate(metrics) -> Dict[str, float]:
+    hits, misses = _counter(metrics.CACHE_HITS), _counter(metrics.CACHE_MISSES)
+    return dict(hits=hits, misses=misses)
+
+
+def _todo_svc_counters() -> Dict[str, float]:
+    from todo_svc import metrics as todo_metrics
+
+    return dict(**_hit_rate(todo_metrics), queries=_counter(todo_metrics.DB_QUERIES))
+
+
+def _listen(port: int) -> socket.socket:
+    # each todo-svc worker binds its own socket, and the kernel balances connections between them
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("127.0.0.1", port))
+    return sock
+
+
+def todo_svc_worker(port: int, pipe):
+    """
+    Another todo-svc worker, in a process of its own. Answers each message
+    on `pipe` with its counters once it's started, and stops when the pipe
+    is closed.
+    """
+    import uvicorn
+
+    from todo_svc import main as todo_main
+
+    server = uvicorn.Server(uvicorn.Config(todo_main.todo_svc(), log_config=None, lifespan="on"))
+
+    def _answer():
+        while True:
+            try:
+                pipe.recv()
+            except EOFError:
+                server.should_exit = True
+                return
+
+            while not server.started:
+                time.sleep(0.05)
+
+            pipe.send(_todo_svc_counters())
+
+    threading.Thread(target=_answer, daemon=True).start()
+    asyncio.run(server.serve(sockets=[_listen(port)]))
+
+
+def _counters(workers: List[Tuple[multiprocessing.Process, Any]]) -> Dict[str, float]:
+    # summed over this process and the other todo-svc workers
+    counters = _todo_svc_counters()
+
+    for process, pipe in workers:
+        pipe.send(None)
+        while not pipe.poll(1):
+            if not process.is_alive():
+                raise SystemExit(f"a todo-svc worker failed with exit code {process.exitcode}")
+
+        for name, value in pipe.recv().items():
+            counters[name] += value
+
+    return counters
+
+
+async def _run(args, workers: int) -> Dict[str, Any]:
+    import aiohttp
+    import uvicorn
+
+    from api_svc import main as api_main
+    from api_svc import metrics as api_metrics
+    from todo_svc import main as todo_main
+
+    servers = [
+        uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_config=None, lifespan="on"))
+        for app, port in ((todo_main.todo_svc(), args.port), (api_main.api_svc(), args.port + 1))
+    ]
+    tasks = [
+        asyncio.create_task(servers[0].serve(sockets=[_listen(args.port)])),
+        asyncio.create_task(servers[1].serve()),
+    ]
+    while not all(server.started for server in servers):
+        if any(task.done() for task in tasks):
+            raise SystemExit("a service failed to start, see the log above")
+
+        await asyncio.sleep(0.05)
+
+    # started once this process ran the migrations, so that they don't race each other
+    context = multiprocessing.get_context("spawn")
+    others = []
+    for _ in range(workers - 1):
+        pipe, worker_pipe = context.Pipe()
+        process = context.Process(target=todo_svc_worker, args=(args.port, worker_pipe))
+        process.start()
+        worker_pipe.close()
+        others.append((process, pipe))
+
+    try:
+        _counters(others)
+
+        async with aiohttp.ClientSession() as session:
+            workload = Workload(session, f"http://127.0.0.1:{args.port + 1}", args)
+            await workload.setup()
+
+            todo_svc, api_cache = _counters(others), _hit_rate(api_metrics)
+
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    workload.worker(args.requests // args.concurrency, args.seed + worker)
+                    for worker in range(1, args.concurrency + 1)
+                )
+            )
+            elapsed = time.perf_counter() - start
+
+            after = _counters(others)
+    finally:
+        for process, pipe in others:
+            pipe.close()
+            process.join()
+
+        for server in servers:
+            server.should_exit = True
+        await asyncio.gather(*tasks)
+
+    latencies = workload.latencies
+    everything = [sample for samples in latencies.values() for sample in samples]
+
+    def rate(before: Dict[str, float], after: Dict[str, float]) -> float:
+        hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+        return round(hits / (hits + misses), 4) if hits + misses else 0.0
+
+    return dict(
+        **summary(everything),
+        workers=workers,
+        throughput_rps=round(len(everything) / elapsed, 1),
+        errors=workload.errors,
+        db_queries_per_request=round((after["queries"] - todo_svc["queries"]) / len(everything), 3),
+        todo_svc_hit_rate=rate(todo_svc, after),
+        api_svc_hit_rate=rate(api_cache, _hit_rate(api_metrics)),
+        operations={operation: summary(samples) for operation, samples in sorted(latencies.items())},
+    )
+
+
+def run(name: str, args, results: multiprocessing.Queue):
+    os.environ.update(CONFIGS[name], TODO_SVC=f"127.0.0.1:{args.port}", LOG_LEVEL="WARNING")
+    # a single worker would only ever get its own invalidations back
+    workers = args.workers if "INVALIDATION_BUS" in CONFIGS[name] else 1
+    results.put(asyncio.run(_run(args, workers)))
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--lists", type=int, default=40)
+    parser.add_argument("--share", type=int, default=5, help="collaborators of each list")
+    parser.add_argument("--entries", type=int, default=10, help="initial entries of each list")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2, help="todo-svc workers with a bus")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--output", default="workload.json")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+
+    for name in args.configs:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(name, args, queue))
+        process.start()
+
+        while name not in results:
+            try:
+                results[name] = queue.get(timeout=1)
+            except Empty:
+                if not process.is_alive():
+                    raise SystemExit(f"{name}: benchmark process failed with exit code {process.exitcode}")
+
+        process.join()
+
+        print(
+            f"{name:24} {results[name]['throughput_rps']:8.1f} req/s"
+            f"  p50 {results[name]['p50_ms']:7.2f} ms  p99 {results[name]['p99_ms']:7.2f} ms"
+            f"  {results[name]['db_queries_per_request']:5.2f} queries/req"
+            f"  hit rate {results[name]['todo_svc_hit_rate']:.0%} todo-svc,"
+            f" {results[name]['api_svc_hit_rate']:.0%} api-svc"
+        )
+
+    report = dict(
+        commit=_commit(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        python=platform.python_version(),
+        args=vars(args),
+        results=results,
+    )
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import socket
+import struct
+from logging import getLogger
+from secrets import token_hex
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .signal import Signal
+
+logger = getLogger("bus")
+
+Receive = Callable[[bytes], Awaitable[None]]
+Resync = Callable[[], Awaitable[None]]
+
+
+def _spawn(tasks: Set[asyncio.Task], coro: Awaitable):
+    task = asyncio.ensure_future(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+class Transport:
+    """
+    Delivers opaque payloads to all processes listening on the same channel,
+    including the sender.
+    """
+
+    # maximum size of a single payload, in bytes
+    max_payload = 65000
+
+    async def start(self, receive: Receive, resync: Optional[Resync] = None):
+        """
+        Start delivering payloads to `receive`. Transports which can tell
+        that payloads might have been lost, e.g. when a connection drops, call
+        `resync` once they're delivering again.
+        """
+        raise NotImplementedError
+
+    async def send(self, payload: bytes):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class LocalBroker:
+    """
+    In-process stand-in for a message broker, connecting `LocalTransport`
+    instances. Useful for tests and for running several apps in one process.
+    """
+
+    def __init__(self):
+        self.transports: Set["LocalTransport"] = set()
+
+    async def send(self, payload: bytes):
+        for transport in list(self.transports):
+            await transport.receive(payload)
+
+
+class LocalTransport(Transport):
+    def __init__(self, broker: LocalBroker):
+        self.broker = broker
+
+    async def start(self, receive: Receive, resync: Optional[Resync] = None):
+        self.receive = receive
+        self.broker.transports.add(self)
+
+    async def send(self, payload: bytes):
+        await self.broker.send(payload)
+
+    async def stop(self):
+        self.broker.transports.discard(self)
+
+
+class _MulticastProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receive: Receive):
+        self.receive = receive
+        self.tasks: Set[asyncio.Task] = set()
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        _spawn(self.tasks, self.receive(data))
+
+
+class MulticastTransport(Transport):
+    """
+    UDP multicast fan-out. With the default TTL of 1, datagrams reach all
+    workers on the host and all replicas on the same network segment, without
+    any broker in between.
+    """
+
+    max_payload = 8192
+
+    def __init__(
+        self,
+        group: str = "239.255.42.42",
+        port: int = 4242,
+        ttl: int = 1,
+        interface: str = "0.0.0.0",
+    ):
+        self.group = group
+        self.port = port
+        self.ttl = ttl
+        self.interface = interface
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    async def start(self, receive: Receive, resync: Optional[Resync] = None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.bind(("", self.port))
+
+        membership = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton(self.interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _MulticastProtocol(receive),
+            sock=sock,
+        )
+
+    async def send(self, payload: bytes):
+        assert self.transport is not None
+        self.transport.sendto(payload, (self.group, self.port))
+
+    async def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class PostgresTransport(Transport):
+    """
+    Postgres LISTEN/NOTIFY. Reaches every replica connected to the same
+    database, at the cost of one dedicated connection per process.
+
+    Notifications sent while the connection is down are lost, so it's
+    checked every `keepalive` seconds, and reconnected when it's closed or
+    stops responding. Once reconnected, the bus is asked to resync.
+    """
+
+    # see https://www.postgresql.org/docs/current/sql-notify.html
+    max_payload = 7999
+
+    def __init__(
+        self,
+        dsn: str,
+        channel: str = "invalidate",
+        keepalive: float = 5.0,
+        max_backoff: float = 30.0,
+    ):
+        self.dsn = dsn
+        self.channel = channel
+        self.keepalive = keepalive
+        self.max_backoff = max_backoff
+        self.connection = None
+        self.lost = asyncio.Event()
+        self.supervisor: Optional[asyncio.Task] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def start(self, receive: Receive, resync: Optional[Resync] = None):
+        self.receive = receive
+        self.resync = resync
+
+        await self._connect()
+        self.supervisor = asyncio.create_task(self._supervise())
+
+    def _listener(self, connection, pid, channel, payload):
+        _spawn(self.tasks, self.receive(payload.encode()))
+
+    def _terminated(self, connection):
+        if connection is self.connection:
+            self.lost.set()
+
+    async def _connect(self):
+        import asyncpg
+
+        connection = await asyncpg.connect(self.dsn)
+        await connection.add_listener(self.channel, self._listener)
+        connection.add_termination_listener(self._terminated)
+        self.connection = connection
+
+    async def _supervise(self):
+        import asyncpg
+
+        errors = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+        while True:
+            try:
+                await asyncio.wait_for(self.lost.wait(), self.keepalive)
+            except asyncio.TimeoutError:
+                try:
+                    await asyncio.wait_for(self.connection.fetchval("SELECT 1"), self.keepalive)
+                    continue
+                except errors as ex:
+                    logger.warning("LISTEN connection is not responding: %s", ex)
+
+            connection, self.connection = self.connection, None
+            connection.terminate()
+
+            backoff = 0.1
+            while self.connection is None:
+                try:
+                    await self._connect()
+                except errors as ex:
+                    logger.warning("LISTEN connection failed, retrying in %.1fs: %s", backoff, ex)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+
+            self.lost.clear()
+            logger.warning("LISTEN connection restored, notifications might have been missed")
+
+            if self.resync is not None:
+                await self.resync()
+
+    async def send(self, payload: bytes):
+        if self.connection is None:
+            raise ConnectionError("LISTEN connection is down")
+
+        await self.connection.execute("SELECT pg_notify($1, $2)", self.channel, payload.decode())
+
+    async def stop(self):
+        if self.supervisor is not None:
+            self.supervisor.cancel()
+            await asyncio.gather(self.supervisor, return_exceptions=True)
+
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+
+class Bus:
+    """
+    Relays events published on attached signals to other processes, and
+    dispatches events received from other processes to local subscribers.
+
+    Outgoing events are not sent one by one. They're collected for `linger`
+    seconds, identical events are coalesced, and the whole batch is sent in as
+    few payloads as the transport allows.
+
+    Events which couldn't be sent, e.g. while the transport reconnects, are
+    kept and sent again every `retry` seconds, together with newer ones.
+
+    When the transport might have lost events, callbacks registered with
+    `on_resync` are called, so that whatever depends on them, e.g. a cache,
+    can start over.
+    """
+
+    def __init__(self, transport: Transport, linger: float = 0.002, retry: float = 1.0):
+        self.transport = transport
+        self.linger = linger
+        self.retry = retry
+        self.origin = token_hex(8)
+
+        self.signals: Dict[str, Signal] = {}
+        self.pending: Dict[Tuple, Tuple[str, Dict[str, Any]]] = {}
+        self.wakeup = asyncio.Event()
+        self.sender: Optional[asyncio.Task] = None
+        self.resync_callbacks: List[Callable[[], None]] = []
+
+    def attach(self, name: str, signal: Signal):
+        self.signals[name] = signal
+        signal.relay = lambda event: self.enqueue(name, event)
+
+    def enqueue(self, name: str, event: Dict[str, Any]):
+        self.pending[(name, *sorted(event.items()))] = (name, event)
+        self.wakeup.set()
+
+    def on_resync(self, callback: Callable[[], None]):
+        self.resync_callbacks.append(callback)
+
+    async def resync(self):
+        for callback in self.resync_callbacks:
+            callback()
+
+    async def start(self):
+        await self.transport.start(self.receive, self.resync)
+        self.sender = asyncio.create_task(self._send_forever())
+
+    async def stop(self):
+        if self.sender is not None:
+            self.sender.cancel()
+            await asyncio.gather(self.sender, return_exceptions=True)
+
+        await self.flush()
+        await self.transport.stop()
+
+    async def _send_forever(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.linger)
+
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.warning("Failed to send invalidations, retrying in %.1fs: %s", self.retry, ex)
+                await asyncio.sleep(self.retry)
+
+    async def flush(self):
+        self.wakeup.clear()
+        events, self.pending = self.pending, {}
+        sent = 0
+
+        try:
+            for payload, count in self._pack(list(events.values())):
+                await self.transport.send(payload)
+                sent += count
+        except BaseException:
+            # peers would keep serving what these events invalidate, so they go out with the next batch
+            self.pending = {**dict(list(events.items())[sent:]), **self.pending}
+            self.wakeup.set()
+            raise
+
+    def _pack(self, events: List[Tuple[str, Dict[str, Any]]]) -> Iterable[Tuple[bytes, int]]:
+        # payloads, and how many events each of them carries
+        head, tail = f'{{"origin":"{self.origin}","events":['.encode(), b"]}"
+        batch: List[bytes] = []
+        size = len(head) + len(tail)
+
+        for event in events:
+            encoded = json.dumps(event, separators=(",", ":")).encode()
+
+            if batch and size + len(encoded) + 1 > self.transport.max_payload:
+                yield head + b",".join(batch) + tail, len(batch)
+                batch, size = [], len(head) + len(tail)
+
+            batch.append(encoded)
+            size += len(encoded) + 1
+
+        if batch:
+            yield head + b",".join(batch) + tail, len(batch)
+
+    async def receive(self, payload: bytes):
+        message = json.loads(payload)
+
+        if message["origin"] == self.origin:
+            return
+
+        events: Dict[str, List[Dict[str, Any]]] = {}
+        for name, event in message["events"]:
+            events.setdefault(name, []).append(event)
+
+        for name, batch in events.items():
+            if signal := self.signals.get(name):
+                await signal.dispatch_many(batch)
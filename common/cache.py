@@ -1,10 +1,598 @@
 import logging
+import time
 from base64 import b64encode
+from collections import Counter, OrderedDict
 from dataclasses import dataclass, field
-from hashlib import sha1
+from functools import lru_cache, partial
+from hashlib import sha1, sha256
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional, Set, Tuple
 
-from fastapi import Request, Response
-from starlette.datastructures import Headers, Scope
+from fastapi import Depends, HTTPException, Request, Response, status
+from starlette.datastructures import URL, Headers, Scope
 from starlette.types import ASGIApp, Message, Receive, Send
 
+from .metrics import (
+    CACHE_BYTES,
+    CACHE_ENTRIES,
+    CACHE_EVICTIONS,
+    CACHE_HITS,
+    CACHE_INVALIDATIONS,
+    CACHE_MISSES,
+    CACHE_NOT_MODIFIED,
+    record_span,
+    span,
+)
+
 logger = logging.getLogger("cache")
+
+CACHEABLE_METHODS = {"GET", "HEAD"}
+
+# methods cacheable when the request says it's a lookup, by sending `Repr-Digest` of its body
+DIGEST_METHODS = {"POST", "QUERY"}
+
+# see https://www.rfc-editor.org/rfc/rfc9110#section-15.4.5
+NOT_MODIFIED_HEADERS = {b"cache-control", b"content-location", b"date", b"etag", b"expires", b"vary"}
+
+
+# (method, url, vary header names, vary header values)
+CacheKey = Tuple[str, str, Tuple[str, ...], Tuple[Optional[str], ...]]
+
+
+def _ignore():
+    pass
+
+
+def parse_etags(header: str) -> List[str]:
+    # If-None-Match uses weak comparison, so W/ prefix doesn't matter
+    return [etag.strip().removeprefix("W/") for etag in header.split(",")]
+
+
+def make_etag(digest: bytes) -> str:
+    return f'"{b64encode(digest).decode()}"'
+
+
+def etag(body: bytes) -> str:
+    """
+    ETag of a response body, the same one `CacheMiddleware` would add.
+    """
+    return make_etag(sha1(body).digest())
+
+
+def repr_digest(body: bytes) -> str:
+    # see https://www.rfc-editor.org/rfc/rfc9530
+    return f"sha-256=:{b64encode(sha256(body).digest()).decode()}:"
+
+
+def is_cacheable(method: str, request_headers: Mapping[str, str]) -> bool:
+    """
+    Whether responses to the request may be cached. Requests with a body
+    qualify when they carry its `Repr-Digest`, so that views can add it to
+    `Vary`, and the body becomes part of the cache key.
+    """
+    return method in CACHEABLE_METHODS or (method in DIGEST_METHODS and "repr-digest" in request_headers)
+
+
+@lru_cache(maxsize=1024)
+def parse_vary(header: str) -> Tuple[str, ...]:
+    # handlers declare the same few Vary headers over and over, so parse each one only once
+    return tuple(sorted({name.strip().lower() for name in header.split(",")} - {""}))
+
+
+@lru_cache(maxsize=1024)
+def parse_cache_control(header: str) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+
+    for directive in header.split(","):
+        name, _, value = directive.partition("=")
+        if name := name.strip().lower():
+            directives[name] = value.strip().strip('"') or None
+
+    return directives
+
+
+def cache_key(method: str, url, vary: Tuple[str, ...], request_headers: Mapping[str, str]) -> CacheKey:
+    """
+    Build the cache key from the request headers listed in `vary`. Both the
+    server middleware and the client session use this function, so that both
+    tiers agree on what's the same representation.
+    """
+    values = (request_headers.get(name) for name in vary)
+    return (method, str(url), vary, tuple(value.strip() if value is not None else None for value in values))
+
+
+class VaryIndex:
+    """
+    Remembers which request headers responses for a given URL vary on, so that
+    a lookup can compute the key without the response at hand.
+
+    The index is bounded, and forgets least recently used URLs. Forgetting is
+    harmless: it only makes the next lookup for that URL a miss.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.index: OrderedDict[str, Tuple[str, ...]] = OrderedDict()
+
+    def vary(self, url) -> Optional[Tuple[str, ...]]:
+        """
+        Headers responses for `url` vary on, or None if there was no
+        response yet.
+        """
+        return self.index.get(str(url))
+
+    def key(self, method: str, url, request_headers: Mapping[str, str]) -> CacheKey:
+        return cache_key(method, url, self.vary(url) or (), request_headers)
+
+    def record(self, url, vary_header: str) -> Tuple[str, ...]:
+        url = str(url)
+        self.index[url] = vary = parse_vary(vary_header)
+        self.index.move_to_end(url)
+
+        if len(self.index) > self.max_entries:
+            self.index.popitem(last=False)
+
+        return vary
+
+    def clear(self):
+        self.index.clear()
+
+
+@dataclass
+class CacheEntry:
+    etag: str
+    response_headers: Mapping[str, str]
+    expires: float
+    size: int = 0
+    body: bytes = b""
+
+    def seconds(self, directive: str) -> float:
+        """
+        Value of a `Cache-Control` directive, such as `max-age`, in seconds.
+        Missing or malformed directives count as 0.
+        """
+        value = parse_cache_control(self.response_headers.get("cache-control", "")).get(directive)
+
+        try:
+            return float(value or 0)
+        except ValueError:
+            return 0.0
+
+    def matches(self, if_none_match: str) -> bool:
+        etags = parse_etags(if_none_match)
+        return "*" in etags or self.etag in etags
+
+    @property
+    def not_modified_headers(self) -> List[Tuple[bytes, bytes]]:
+        return [
+            (name.encode(), value.encode())
+            for name, value in self.response_headers.items()
+            if name.encode() in NOT_MODIFIED_HEADERS
+        ]
+
+
+class MemoryCache:
+    """
+    In-memory LRU store of ETags, keyed by method, URL and values of request
+    headers listed in the response's `Vary`. Optionally, the store keeps
+    response body as well, so that clients can reuse it on `304 Not Modified`.
+
+    The store is bounded both by number of entries and by number of bytes held
+    by the keys, response headers and bodies. When either limit is exceeded,
+    least recently used entries are evicted. Entries also expire after `max_age`
+    seconds, regardless of whether they were used.
+
+    On the server, views declare which model changes invalidate their response
+    via `drop_on`. Responses which didn't declare anything are not stored.
+    Without `invalidate`, declared responses are stored all the same, but
+    changes don't drop them, and they're served until they expire.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        max_bytes: int = 16 * 1024 * 1024,
+        max_age: float = 60.0,
+        invalidate: bool = True,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.invalidate = invalidate
+
+        self.cache: OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        self.vary = VaryIndex(max_entries)
+        self.bytes = 0
+
+        self.subscriptions: Dict[CacheKey, Dict[Tuple, Callable[[], None]]] = {}
+        self.inflight: Counter[CacheKey] = Counter()
+        self.invalidated: Set[CacheKey] = set()
+
+    def __contains__(self, key: CacheKey):
+        return key in self.cache
+
+    def _size(self, key, etag, response_headers, body):
+        method, url, vary, values = key
+        return (
+            len(method)
+            + len(url)
+            + sum(len(name) + len(value or "") for name, value in zip(vary, values))
+            + len(etag)
+            + sum(len(name) + len(value) for name, value in response_headers.items())
+            + len(body)
+        )
+
+    def get(self, method, url, request_headers) -> Optional[CacheEntry]:
+        key = self.vary.key(method, url, request_headers)
+
+        if (entry := self._load(key)) is None:
+            return None
+
+        if entry.expires < time.monotonic():
+            self._discard(key)
+            self._unsubscribe(key)
+            return None
+
+        return entry
+
+    def age(self, entry: CacheEntry) -> float:
+        """
+        Seconds since the entry was stored or last revalidated.
+        """
+        return time.monotonic() - (entry.expires - self.max_age)
+
+    def record(self, method, url, request_headers, response_headers) -> Optional[CacheKey]:
+        vary = self.vary.record(url, response_headers.get("vary", ""))
+        if "*" in vary:
+            return None
+
+        return cache_key(method, url, vary, request_headers)
+
+    def store(self, method, url, request_headers, etag, response_headers, body=b""):
+        if key := self.record(method, url, request_headers, response_headers):
+            self.put(key, etag, response_headers, body)
+
+    def put(self, key: CacheKey, etag: str, response_headers, body=b""):
+        # the response was computed before a change it depends on got committed
+        if key in self.invalidated:
+            return
+
+        size = self._size(key, etag, response_headers, body)
+        entry = CacheEntry(etag, response_headers, time.monotonic() + self.max_age, size, body)
+
+        if not self._save(key, entry):
+            self.drop(key)
+
+    def drop(self, key: CacheKey):
+        if entry := self._discard(key):
+            logger.info("DROP %s %s", key[1], entry.etag)
+            CACHE_INVALIDATIONS.inc()
+
+        self._unsubscribe(key)
+
+        if key in self.inflight:
+            self.invalidated.add(key)
+
+    def drop_on(self, key: CacheKey, model, **filter) -> Callable[[], None]:
+        """
+        Drop the entry stored under `key` when `model` publishes a change
+        matching `filter`. Returns a function cancelling just this
+        subscription.
+
+        Views should subscribe *before* reading the data they depend on, so
+        that there's no window when a change could go unnoticed.
+        """
+        subscriptions = self.subscriptions.setdefault(key, {})
+        tag = (model, *sorted(filter.items()))
+
+        if tag not in subscriptions:
+            if self.invalidate:
+                subscriptions[tag] = model.subscribe(partial(self.drop, key), **filter)
+            else:
+                # the entry is stored all the same, but nothing drops it
+                subscriptions[tag] = _ignore
+
+        def _unsubscribe():
+            if unsubscribe := self.subscriptions.get(key, {}).pop(tag, None):
+                unsubscribe()
+
+        return _unsubscribe
+
+    def _unsubscribe(self, key: CacheKey):
+        for unsubscribe in self.subscriptions.pop(key, {}).values():
+            unsubscribe()
+
+    def vary_on(self, *vary_headers: str):
+        """
+        FastAPI dependency declaring request headers the response depends on.
+        Adds them to the response's `Vary` and returns the cache key the
+        response is going to be stored under.
+        """
+        vary = parse_vary(",".join(vary_headers))
+
+        async def _vary_on(request: Request, response: Response):
+            if vary:
+                response.headers["vary"] = ", ".join(vary)
+
+            key = cache_key(request.method, request.url, vary, request.headers)
+
+            self.inflight[key] += 1
+            try:
+                yield key
+            finally:
+                self.inflight[key] -= 1
+                if not self.inflight[key]:
+                    del self.inflight[key]
+                    self.invalidated.discard(key)
+
+                # response didn't make it into the cache, nothing to drop
+                if key not in self:
+                    self._unsubscribe(key)
+
+        return Depends(_vary_on)
+
+    def if_match(self, current: Callable[..., Awaitable[bytes]]):
+        """
+        FastAPI dependency evaluating `If-Match` of a write against the ETag
+        of what `GET` of the same URL returns, and failing with `412
+        Precondition Failed` when none of them match.
+
+        The ETag is taken from the store, so checking a resource someone read
+        lately costs no DB read. Otherwise, `current` is called with path
+        parameters to render the body `GET` would return, and its ETag is
+        computed from that.
+
+        The check isn't atomic with the write. It catches lost updates
+        between a read and a write, not between two concurrent writes.
+        """
+
+        async def _if_match(request: Request):
+            if (header := request.headers.get("if-match")) is None:
+                return
+
+            # If-Match uses strong comparison, so W/ tags never match
+            etags = [tag.strip() for tag in header.split(",")]
+            if "*" in etags:
+                return
+
+            if entry := self.get("GET", request.url, request.headers):
+                current_etag = entry.etag
+            else:
+                current_etag = etag(await current(**request.path_params))
+
+            if current_etag not in etags:
+                logger.info("PRECONDITION %s %s", request.url.path, current_etag)
+                raise HTTPException(
+                    status_code=status.HTTP_412_PRECONDITION_FAILED,
+                    detail="Resource has changed",
+                )
+
+        return Depends(_if_match)
+
+    def clear(self):
+        for key in list(self.subscriptions):
+            self._unsubscribe(key)
+
+        CACHE_ENTRIES.dec(len(self.cache))
+        CACHE_BYTES.dec(self.bytes)
+
+        self.cache.clear()
+        self.vary.clear()
+        self.bytes = 0
+
+    # storage, overridden by other backends
+
+    def _load(self, key: CacheKey) -> Optional[CacheEntry]:
+        if entry := self.cache.get(key):
+            self.cache.move_to_end(key)
+
+        return entry
+
+    def _save(self, key: CacheKey, entry: CacheEntry) -> bool:
+        self._discard(key)
+
+        if entry.size > self.max_bytes:
+            return False
+
+        self.cache[key] = entry
+        self.bytes += entry.size
+        CACHE_ENTRIES.inc()
+        CACHE_BYTES.inc(entry.size)
+        self._evict()
+        return True
+
+    def _discard(self, key: CacheKey) -> Optional[CacheEntry]:
+        if entry := self.cache.pop(key, None):
+            self.bytes -= entry.size
+            CACHE_ENTRIES.dec()
+            CACHE_BYTES.dec(entry.size)
+
+        return entry
+
+    def _evict(self):
+        while len(self.cache) > self.max_entries or self.bytes > self.max_bytes:
+            key, entry = self.cache.popitem(last=False)
+            self.bytes -= entry.size
+            CACHE_ENTRIES.dec()
+            CACHE_BYTES.dec(entry.size)
+            CACHE_EVICTIONS.inc()
+            self._unsubscribe(key)
+            logger.debug("EVICT %s %s", key[1], entry.etag)
+
+
+class CacheSend:
+    """
+    Wraps ASGI `send` to hash the response body as it's being streamed by the
+    application, so that the ETag can be added to the response headers.
+
+    Since headers go before the body, the whole response is held back until
+    the last body chunk arrives. Responses other than `200 OK`, and streamed
+    ones, without `Content-Length`, are passed through as-is. If the ETag
+    turns out to match `If-None-Match`, the body isn't sent at all.
+    """
+
+    def __init__(
+        self,
+        cache: MemoryCache,
+        method: str,
+        url: URL,
+        request_headers: Headers,
+        send: Send,
+        cache_control: Optional[str] = None,
+    ):
+        self.cache = cache
+        self.cache_control = cache_control
+        self.method = method
+        self.url = url
+        self.request_headers = request_headers
+        self.send = send
+
+        self.response_start: Optional[Message] = None
+        self.response_body: List[Message] = []
+        self.hash = sha1()
+
+    @property
+    def response_headers(self):
+        return Headers(raw=self.response_start["headers"])
+
+    async def __call__(self, message: Message):
+        if message["type"] == "http.response.start":
+            # holding back a streamed response would defeat the purpose of streaming it
+            streamed = not any(name == b"content-length" for name, _ in message.get("headers", []))
+
+            if message["status"] != 200 or streamed:
+                await self.send(message)
+                return
+
+            self.response_start = message
+            return
+
+        if self.response_start is None:
+            await self.send(message)
+            return
+
+        assert message["type"] == "http.response.body"
+
+        started = perf_counter()
+        self.hash.update(message.get("body", b""))
+        self.response_body.append(message)
+
+        if message.get("more_body"):
+            record_span("cache", perf_counter() - started)
+            return
+
+        etag = make_etag(self.hash.digest())
+        self.response_start["headers"] = [
+            *((name, value) for name, value in self.response_start["headers"] if name != b"etag"),
+            (b"etag", etag.encode()),
+        ]
+
+        headers = self.response_start["headers"]
+        if self.cache_control and not any(name == b"cache-control" for name, _ in headers):
+            headers.append((b"cache-control", self.cache_control.encode()))
+
+        response_headers = self.response_headers
+        if key := self.cache.record(self.method, self.url, self.request_headers, response_headers):
+            if key in self.cache.subscriptions:
+                logger.info("STORE %s %s", self.url.path, etag)
+                self.cache.put(key, etag, response_headers)
+
+        record_span("cache", perf_counter() - started)
+
+        # the entry was dropped or evicted, but the client's copy is still the same
+        etags = parse_etags(self.request_headers.get("if-none-match", ""))
+        if "*" in etags or etag in etags:
+            logger.info("SAME %s %s", self.url.path, etag)
+            CACHE_NOT_MODIFIED.inc()
+            headers = [(name, value) for name, value in headers if name in NOT_MODIFIED_HEADERS]
+            await self.send(dict(type="http.response.start", status=304, headers=headers))
+            await self.send(dict(type="http.response.body", body=b"", more_body=False))
+            return
+
+        await self.send(self.response_start)
+        for body in self.response_body:
+            await self.send(body)
+
+
+class CacheMiddleware:
+    """
+    Pure ASGI middleware adding ETags to `GET` responses and answering
+    conditional requests with `304 Not Modified`, without calling the
+    application at all.
+
+    If `cache_control` is given, it's added to responses which don't set
+    `Cache-Control` themselves, telling clients how long they may reuse
+    them without asking.
+    """
+
+    def __init__(self, app: ASGIApp, cache: MemoryCache, cache_control: Optional[str] = None):
+        self.app = app
+        self.cache = cache
+        self.cache_control = cache_control
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        request_headers = Headers(scope=scope)
+
+        if not is_cacheable(method, request_headers):
+            await self.app(scope, receive, send)
+            return
+
+        if method in DIGEST_METHODS:
+            scope, receive = await self._digest(scope, receive)
+            request_headers = Headers(scope=scope)
+
+        url = URL(scope=scope)
+
+        if if_none_match := request_headers.get("if-none-match"):
+            with span("cache"):
+                entry = self.cache.get(method, url, request_headers)
+
+            if entry:
+                if entry.matches(if_none_match):
+                    logger.info("HIT %s %s", url.path, entry.etag)
+                    CACHE_HITS.inc()
+                    CACHE_NOT_MODIFIED.inc()
+                    headers = entry.not_modified_headers
+                    await send(dict(type="http.response.start", status=304, headers=headers))
+                    await send(dict(type="http.response.body", body=b"", more_body=False))
+                    return
+
+        CACHE_MISSES.inc()
+        await self.app(
+            scope, receive, CacheSend(self.cache, method, url, request_headers, send, self.cache_control)
+        )
+
+    async def _digest(self, scope: Scope, receive: Receive) -> Tuple[Scope, Receive]:
+        """
+        Read the whole request body and replace `Repr-Digest` sent by the
+        client with one computed here, so that a wrong digest can't make the
+        response land under someone else's key. The body is then replayed to
+        the application.
+        """
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if message["type"] != "http.request" or not message.get("more_body"):
+                break
+
+        body = b"".join(chunks)
+        headers = [(name, value) for name, value in scope["headers"] if name != b"repr-digest"]
+        headers.append((b"repr-digest", repr_digest(body).encode()))
+
+        replayed = False
+
+        async def _receive() -> Message:
+            nonlocal replayed
+            if replayed:
+                return await receive()
+
+            replayed = True
+            return dict(type="http.request", body=body, more_body=False)
+
+        return {**scope, "headers": headers}, _receive
@@ -2,34 +2,44 @@ from contextvars import ContextVar
 from secrets import token_hex
 from typing import Dict
 
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 _headers: ContextVar[Dict[str, str]] = ContextVar("_user")
 
 
-class RequestHeadersMiddleware(BaseHTTPMiddleware):
+class RequestHeadersMiddleware:
     HEADERS = {
         "x-user",
         "x-role",
         "x-correlation-id",
     }
 
-    async def dispatch(self, request, call_next):
-        _headers.set(
-            {
-                name: value
-                for name, value in request.headers.items()
-                if name in self.HEADERS
-            }
-        )
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.raw_headers = {name.encode("latin-1") for name in self.HEADERS}
 
-        return await call_next(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            _headers.set(
+                {
+                    name.decode("latin-1"): value.decode("latin-1")
+                    for name, value in scope["headers"]
+                    if name in self.raw_headers
+                }
+            )
 
+        await self.app(scope, receive, send)
 
-class CorrelationIdMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        update_headers(**{"x-correlation-id": token_hex(3)})
-        return await call_next(request)
+
+class CorrelationIdMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            update_headers(**{"x-correlation-id": token_hex(3)})
+
+        await self.app(scope, receive, send)
 
 
 def current_headers():
@@ -1,62 +1,392 @@
-from typing import Callable
+import asyncio
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
 from dataclasses import dataclass, field
 from logging import getLogger
+from time import perf_counter
 
 import click
 from fastapi import HTTPException
-from fastapi_async_sqlalchemy import db
-from sqlalchemy import delete, select, update
-from sqlalchemy.dialects.postgresql import insert  # type: ignore
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from sqlalchemy import and_, any_, bindparam, delete, event, exists, literal, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import ARRAY, insert  # type: ignore
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 from starlette.status import HTTP_404_NOT_FOUND
 
+from .metrics import count_query, record_span
+from .signal import Signal
+
 logger = getLogger("crud")
 
+CHANGE: Dict[type, Signal] = defaultdict(Signal)
+
+_publishing: Set[asyncio.Task] = set()
+
+
+async def _publish(changes: List[Tuple[type, Dict[str, Any]]]):
+    rows: Dict[type, List[Dict[str, Any]]] = defaultdict(list)
+
+    for model, row in changes:
+        logger.debug("%s %s %s", click.style("CHANGE", fg="yellow", bold=True), model.__name__, row)
+        rows[model].append(row)
+
+    # a bulk write drops each entry once, however many of its rows the entry depended on
+    for model, batch in rows.items():
+        await CHANGE[model].publish_many(batch)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_changes(session: Session):
+    # Publish only after the transaction is visible to others. Otherwise a
+    # concurrent read could repopulate the cache with data from before the
+    # write, right after the entry has been dropped.
+    if changes := session.info.pop("changes", None):
+        task = asyncio.get_running_loop().create_task(_publish(changes))
+        _publishing.add(task)
+        task.add_done_callback(_publishing.discard)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session: Session):
+    session.info.pop("changes", None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(connection, cursor, statement, parameters, context, executemany):
+    # every round trip, including relationships loaded with separate queries
+    count_query()
+
+    # kept with the statement rather than the pooled connection, so that one which fails leaves nothing behind
+    if context is not None:
+        context.query_started = perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_query(connection, cursor, statement, parameters, context, executemany):
+    if (started := getattr(context, "query_started", None)) is not None:
+        record_span("db", perf_counter() - started)
+
+
+class TimedSQLAlchemyMiddleware(SQLAlchemyMiddleware):
+    """
+    `SQLAlchemyMiddleware` recording time spent opening the request's
+    session and committing it on exit as the `session` stage, apart from the
+    application running in between.
+    """
+
+    async def dispatch(self, request, call_next):
+        started, inner = perf_counter(), 0.0
+
+        async def _call_next(request):
+            nonlocal inner
+            called = perf_counter()
+            try:
+                return await call_next(request)
+            finally:
+                inner += perf_counter() - called
+
+        try:
+            return await super().dispatch(request, _call_next)
+        finally:
+            record_span("session", perf_counter() - started - inner)
+
 
 class CrudMixin:
+    # relationships included by `to_dict`
+    __serialized__: Tuple[str, ...] = ()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Project the object into a dict of plain values, ready to be encoded
+        as JSON without walking its attributes.
+        """
+        row = {column.key: getattr(self, column.key) for column in self.__table__.columns}
+
+        for name in self.__serialized__:
+            row[name] = [related.to_dict() for related in getattr(self, name)]
+
+        return row
+
+    @classmethod
+    def subscribe(cls, callback: Callable, **filter) -> Callable[[], None]:
+        """
+        Call `callback` after a transaction changing a row with fields
+        matching `filter` is committed. Returns a function cancelling the
+        subscription.
+        """
+        return CHANGE[cls].subscribe(filter, callback)
+
+    @classmethod
+    async def _write(cls, stmt):
+        stmt = stmt.returning(*cls.__table__.columns)
+        rows = [dict(row) for row in (await db.session.execute(stmt)).mappings()]
+        db.session.info.setdefault("changes", []).extend((cls, row) for row in rows)
+        return rows
+
     @classmethod
     async def create(cls, **kwargs):
         stmt = insert(cls).values(kwargs)
-        await db.session.execute(stmt)
+        await cls._write(stmt)
+
+    @classmethod
+    async def create_within(cls, parent, *args, **kwargs):
+        """
+        Insert a row only if a `parent` row matching `args` exists, raising
+        404 otherwise. Both the check and the insert are a single
+        `INSERT ... SELECT ... WHERE EXISTS`.
+        """
+        columns = cls.__table__.columns
+        values = select(*(literal(value, columns[name].type) for name, value in kwargs.items()))
+
+        stmt = insert(cls).from_select(list(kwargs), values.where(exists().where(*args)))
+        if not await cls._write(stmt):
+            raise HTTPException(
+                status_code=HTTP_404_NOT_FOUND,
+                detail=f"{parent.__name__} doesn't exist",
+            )
 
     @classmethod
     async def update(cls, *key, **data):
         stmt = update(cls).where(*key).values(**data)
-        await db.session.execute(stmt)
+        return await cls._write(stmt)
 
     @classmethod
     async def merge(cls, key, /, **data):
         stmt = insert(cls).values(**key, **data).on_conflict_do_update(index_elements=key, set_=data)
-        await db.session.execute(stmt)
+        await cls._write(stmt)
+
+    @classmethod
+    async def merge_many(cls, key: Iterable[str], rows: List[Dict[str, Any]]):
+        """
+        Upsert all `rows` in a single `INSERT ... ON CONFLICT DO UPDATE`,
+        using columns listed in `key` as the conflict target.
+        """
+        key = list(key)
+
+        # Postgres refuses to update the same row twice in one statement
+        rows = list({tuple(row[name] for name in key): row for row in rows}.values())
+        if not rows:
+            return
+
+        stmt = insert(cls).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key,
+            set_={name: stmt.excluded[name] for name in rows[0] if name not in key},
+        )
+        await cls._write(stmt)
 
     @classmethod
     async def delete(cls, *args, **kwargs):
         stmt = delete(cls).filter(*args, **kwargs)
-        await db.session.execute(stmt)
+        await cls._write(stmt)
+
+    @classmethod
+    async def delete_many(cls, column, values: Iterable[Any], *args, **kwargs):
+        """
+        Delete rows whose `column` is any of `values`, with a single
+        `DELETE ... WHERE column = ANY(...)`, binding `values` as one array.
+        """
+        values = list(values)
+        if not values:
+            return
+
+        array = bindparam(f"{column.key}_any", values, type_=ARRAY(column.type))
+        stmt = delete(cls).filter(column == any_(array), *args).filter_by(**kwargs)
+        await cls._write(stmt)
+
+    @classmethod
+    def _select(
+        cls,
+        args,
+        kwargs,
+        columns: Optional[Sequence],
+        options: Sequence,
+        order_by: Sequence = (),
+        limit: Optional[int] = None,
+    ):
+        """
+        Select whole objects, with relationships loaded according to their
+        `lazy` setting unless `options` say otherwise, or just the given
+        `columns`, returned as dicts.
+        """
+        if columns:
+            stmt = select(*columns).filter(*args, **kwargs)
+        else:
+            stmt = select(cls).filter(*args, **kwargs).options(*options)
+
+        return stmt.order_by(*order_by).limit(limit)
 
     @classmethod
-    async def get(cls, *args, **kwargs):
+    def _table_columns(cls, columns: Optional[Sequence]) -> Sequence:
+        # rows are looked up by table columns, model attributes aren't recognized as their keys
+        if columns is None:
+            return list(cls.__table__.columns)
+
+        return [cls.__table__.columns[column.key] for column in columns]
+
+    @classmethod
+    def _select_within(
+        cls, parent, args, filter: Sequence, order_by: Sequence, limit: Optional[int], *entities
+    ):
+        onclause = and_(
+            *(
+                cls.__table__.columns[key.parent.name] == key.column
+                for key in cls.__table__.foreign_keys
+                if key.column.table is parent.__table__
+            ),
+            *filter,
+        )
+        # labelled, so that they don't clash with foreign keys of the selected rows
+        parent_key = [column.label(f"parent_{column.name}") for column in parent.__table__.primary_key]
+        stmt = select(*parent_key, *entities).select_from(parent).outerjoin(cls, onclause)
+        return stmt.filter(*args).order_by(*order_by).limit(limit)
+
+    @classmethod
+    async def get(cls, *args, columns: Optional[Sequence] = None, options: Sequence = (), **kwargs):
         logger.info(
             "%s %s",
             click.style("QUERY", fg="red", bold=True),
             cls.__name__,
         )
-        stmt = select(cls).filter(*args, **kwargs)
-        obj = (await db.session.execute(stmt)).unique().scalars().one_or_none()
+        stmt = cls._select(args, kwargs, columns, options)
+        result = await db.session.execute(stmt)
+        # unique() only folds entities repeated by joined eager loading; equal projected rows are still rows
+        obj = result.mappings().one_or_none() if columns else result.unique().scalars().one_or_none()
         if not obj:
             raise HTTPException(
                 status_code=HTTP_404_NOT_FOUND,
                 detail=f"{cls.__name__} doesn't exist",
             )
 
-        return obj
+        return dict(obj) if columns else obj
+
+    @classmethod
+    async def select_within(
+        cls,
+        parent,
+        *args,
+        columns: Optional[Sequence] = None,
+        filter: Sequence = (),
+        order_by: Sequence = (),
+        limit: Optional[int] = None,
+    ):
+        """
+        Select rows referencing the `parent` row matching `args`, raising 404
+        if there's no such parent. Instead of querying the parent first,
+        the parent is outer joined with the selected rows, so that the
+        result has at least one row whenever the parent exists.
+
+        Conditions on the selected rows go to `filter`, so that they're part
+        of the join rather than of the `WHERE` clause.
+
+        Like with `select`, given `columns` are returned as dicts instead of
+        whole objects. The first one must not be nullable, e.g. the primary
+        key, since it tells rows from the parent without any.
+        """
+        logger.info(
+            "%s %s",
+            click.style("QUERY", fg="red", bold=True),
+            cls.__name__,
+        )
+        if columns is None:
+            stmt = cls._select_within(parent, args, filter, order_by, limit, cls)
+        else:
+            columns = cls._table_columns(columns)
+            stmt = cls._select_within(parent, args, filter, order_by, limit, *columns)
+
+        result = await db.session.execute(stmt)
+        rows = result.all() if columns is None else result.mappings().all()
+        if not rows:
+            raise HTTPException(
+                status_code=HTTP_404_NOT_FOUND,
+                detail=f"{parent.__name__} doesn't exist",
+            )
+
+        if columns is None:
+            return [row[-1] for row in rows if row[-1] is not None]
+
+        return [
+            {column.name: row[column] for column in columns} for row in rows if row[columns[0]] is not None
+        ]
 
     @classmethod
-    async def select(cls, *args, **kwargs):
-        stmt = select(cls).filter(*args, **kwargs)
-        objs = (await db.session.execute(stmt)).unique().scalars().all()
+    async def select(
+        cls,
+        *args,
+        columns: Optional[Sequence] = None,
+        options: Sequence = (),
+        order_by: Sequence = (),
+        limit: Optional[int] = None,
+        **kwargs,
+    ):
+        stmt = cls._select(args, kwargs, columns, options, order_by, limit)
+        result = await db.session.execute(stmt)
+        objs = [dict(row) for row in result.mappings()] if columns else result.unique().scalars().all()
         logger.info(
             "%s %s",
             click.style("QUERY", fg="red", bold=True),
             cls.__name__
         )
         return objs
+
+    @classmethod
+    async def stream(
+        cls, *args, columns: Sequence, order_by: Sequence = (), limit: Optional[int] = None, **kwargs
+    ):
+        """
+        Like `select` with `columns`, but yields rows one by one from a
+        server-side cursor, so that they don't have to fit in memory at once.
+
+        The request's session is closed as soon as the response starts, so
+        rows are read in a session of their own, which lives as long as the
+        generator.
+        """
+        logger.info(
+            "%s %s",
+            click.style("STREAM", fg="red", bold=True),
+            cls.__name__,
+        )
+        stmt = cls._select(args, kwargs, columns, (), order_by, limit)
+
+        async with AsyncSession(db.session.bind) as session:
+            async for row in (await session.stream(stmt)).mappings():
+                yield dict(row)
+
+    @classmethod
+    async def stream_within(
+        cls,
+        parent,
+        *args,
+        columns: Optional[Sequence] = None,
+        filter: Sequence = (),
+        order_by: Sequence = (),
+        limit: Optional[int] = None,
+    ):
+        """
+        Like `select_within`, but yields dicts of row's `columns`, all of them
+        by default, one by one from a server-side cursor, in a session of its
+        own. The 404 for a missing parent is raised on the first iteration.
+        """
+        logger.info(
+            "%s %s",
+            click.style("STREAM", fg="red", bold=True),
+            cls.__name__,
+        )
+        columns = cls._table_columns(columns)
+        stmt = cls._select_within(parent, args, filter, order_by, limit, *columns)
+
+        async with AsyncSession(db.session.bind) as session:
+            found = False
+
+            async for row in (await session.stream(stmt)).mappings():
+                found = True
+                if row[columns[0]] is not None:
+                    yield {column.name: row[column] for column in columns}
+
+            if not found:
+                raise HTTPException(
+                    status_code=HTTP_404_NOT_FOUND,
+                    detail=f"{parent.__name__} doesn't exist",
+                )
@@ -1,6 +1,12 @@
+import json
 import logging
+import os
+import queue
+import sys
+import threading
 import traceback
 from functools import partial
+from logging.handlers import QueueHandler
 
 import click
 
@@ -54,16 +60,19 @@ class ConsoleLogFormatter(logging.Formatter):
 
     def __init__(self, fmt=None, datefmt=None, style="%", *args, **kwargs):
         super().__init__(fmt=fmt, datefmt=datefmt, style=style)
+        self.level_prefixes = {}
 
     def color_level_name(self, level_name, level_no):
         func = self.level_name_colors.get(level_no, str)
         return func(level_name)
 
     def formatMessage(self, record: logging.LogRecord):
-        levelname = record.levelname
+        # styled once per level, rather than once per record
+        if (levelprefix := self.level_prefixes.get(record.levelno)) is None:
+            levelname = self.LEVEL_COLORS.get(record.levelno, str)(record.levelname)
+            levelprefix = self.level_prefixes[record.levelno] = f"{levelname:16}"
 
-        levelname = self.LEVEL_COLORS[record.levelno](levelname)
-        record.levelprefix = f"{levelname:16}"
+        record.levelprefix = levelprefix
         return super().formatMessage(record)
 
     def format(self, record: logging.LogRecord):
@@ -82,6 +91,90 @@ class ConsoleLogFormatter(logging.Formatter):
         )
 
 
+class JSONLogFormatter(logging.Formatter):
+    """
+    One JSON object per line, without colors, for log collectors rather than
+    for people.
+    """
+
+    def format(self, record: logging.LogRecord):
+        exception, value, tb = _get_exception(record)
+
+        entry = dict(
+            time=record.created,
+            level=record.levelname,
+            logger=record.name,
+            correlation_id=getattr(record, "correlation_id", None),
+            message=click.unstyle(record.getMessage()),
+        )
+
+        if exception:
+            entry.update(exception=exception, detail=str(value), traceback=tb)
+
+        return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Hands records over to a background thread, which formats them and writes
+    them to `stream` in batches, flushing once per batch. The logging thread
+    only pays for filters and a queue put.
+
+    Since records are formatted later, arguments shouldn't be modified after
+    they're logged.
+    """
+
+    def __init__(self, stream=sys.stdout, batch: int = 256):
+        super().__init__(queue.SimpleQueue())
+        self.stream = stream
+        self.batch = batch
+        self.writer = threading.Thread(target=self._write_forever, name="log-writer", daemon=True)
+        self.writer.start()
+
+    def prepare(self, record: logging.LogRecord):
+        # formatting is the writer's job
+        return record
+
+    def _write_forever(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in records:
+                if record is None:
+                    continue
+
+                try:
+                    lines.append(self.format(record) + "\n")
+                except Exception:
+                    self.handleError(record)
+
+            if lines:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+
+            if None in records:
+                return
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+        super().close()
+
+
+# text or json
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+# format and write records in a background thread, e.g. LOG_QUEUE=1
+LOG_QUEUE = bool(os.getenv("LOG_QUEUE"))
+
 LOG_CONFIG = {
     "version": 1,
     "disable_existing_loggers": True,
@@ -92,24 +185,26 @@ LOG_CONFIG = {
             "fmt": "%(name)-25s %(message)s",
             "datefmt": "%Y-%m-%d %H:%M:%S",
         },
+        "json": {"()": JSONLogFormatter},
     },
     "handlers": {
         "console": {
-            "()": "logging.StreamHandler",
+            "()": QueueLogHandler if LOG_QUEUE else "logging.StreamHandler",
             "stream": "ext://sys.stdout",
-            "formatter": "text",
+            "formatter": LOG_FORMAT,
             "filters": ["correlation_id"],
         }
     },
     "root": {
-        "level": logging.DEBUG,
+        "level": LOG_LEVEL,
         "handlers": ["console"],
     },
     "loggers": {
-        "uvicorn": {"level": logging.DEBUG},
-        "svc": {"level": logging.DEBUG},
-        "client": {"level": logging.DEBUG},
-        "crud": {"level": logging.DEBUG},
-        "cache": {"level": logging.DEBUG},
+        "uvicorn": {"level": LOG_LEVEL},
+        "svc": {"level": LOG_LEVEL},
+        "client": {"level": LOG_LEVEL},
+        "crud": {"level": LOG_LEVEL},
+        "cache": {"level": LOG_LEVEL},
+        "bus": {"level": LOG_LEVEL},
     },
 }
@@ -0,0 +1,245 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# see https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        pairs = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+        return f"{name}{{{pairs}}} {value:g}"
+
+    return f"{name} {value:g}"
+
+
+class Registry:
+    """
+    Metrics of this process, rendered in Prometheus text format. Each uvicorn
+    worker has its own, so a scrape sees only the worker which answered it.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        assert metric.name not in self.metrics, f"{metric.name} is already registered"
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, help: str, registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        registry.register(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, registry: Registry = REGISTRY):
+        super().__init__(name, help, registry)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [_format(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        self.values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], registry: Registry = REGISTRY):
+        super().__init__(name, help, registry)
+        self.buckets = sorted(buckets)
+        # per labels: count in each bucket (the last one is +Inf), sum and count of observations
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = _labels(labels)
+        if (found := self.values.get(key)) is None:
+            found = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+
+        counts, totals = found
+        counts[bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def samples(self) -> List[str]:
+        samples = []
+
+        for labels, (counts, (total, count)) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip([*self.buckets, float("inf")], counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                samples.append(_format(f"{self.name}_bucket", (*labels, ("le", le)), cumulative))
+
+            samples.append(_format(f"{self.name}_sum", labels, total))
+            samples.append(_format(f"{self.name}_count", labels, count))
+
+        return samples
+
+
+CACHE_HITS = Counter("cache_hits_total", "Requests answered from the cache")
+CACHE_MISSES = Counter("cache_misses_total", "Cacheable requests the cache couldn't answer")
+CACHE_NOT_MODIFIED = Counter("cache_not_modified_total", "304 Not Modified responses served")
+CACHE_REVALIDATIONS = Counter("cache_revalidations_total", "Conditional requests sent upstream")
+CACHE_INVALIDATIONS = Counter("cache_invalidations_total", "Entries dropped when their data changed")
+CACHE_EVICTIONS = Counter("cache_evictions_total", "Entries evicted to stay within limits")
+CACHE_ENTRIES = Gauge("cache_entries", "Entries held by in-memory caches")
+CACHE_BYTES = Gauge("cache_bytes", "Bytes held by in-memory caches")
+
+DB_QUERIES = Counter("db_queries_total", "Statements sent to the database")
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "Statements sent to the database while handling a request",
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21),
+)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response is complete, per route",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+@dataclass
+class RequestStats:
+    started: float = field(default_factory=perf_counter)
+    # path template of the matched route, set by `LoggingRoute`
+    route: Optional[str] = None
+    queries: int = 0
+    # seconds spent in each stage, in the order stages were first entered
+    spans: Dict[str, float] = field(default_factory=dict)
+
+    def server_timing(self) -> str:
+        # see https://www.w3.org/TR/server-timing/
+        spans = [*self.spans.items(), ("total", perf_counter() - self.started)]
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans)
+
+
+# Stats of the request being handled. Like the `x-correlation-id` header, it's carried in the context, so it
+# follows the request into tasks it spawns; these update the same object.
+_request: ContextVar[Optional[RequestStats]] = ContextVar("_request", default=None)
+
+
+def current_request() -> Optional[RequestStats]:
+    return _request.get()
+
+
+def count_query():
+    DB_QUERIES.inc()
+
+    if (request := _request.get()) is not None:
+        request.queries += 1
+
+
+def record_span(name: str, seconds: float):
+    if (request := _request.get()) is not None:
+        request.spans[name] = request.spans.get(name, 0.0) + seconds
+
+
+@contextmanager
+def span(name: str):
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, perf_counter() - started)
+
+
+def merge_server_timing(header: str, prefix: str):
+    """
+    Add stages from an upstream `Server-Timing` header to the current
+    request, with their names prefixed, e.g. `todo-svc.db`.
+    """
+    for metric in header.split(","):
+        name, *params = (part.strip() for part in metric.split(";"))
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "dur":
+                try:
+                    record_span(f"{prefix}.{name}", float(value) / 1000)
+                except ValueError:
+                    pass
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware recording per-request metrics: the number of DB
+    queries each request needed and its latency per route. Time spent in
+    recorded stages is added to the response as a `Server-Timing` header.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestStats()
+        token = _request.set(request)
+
+        async def _send(message: Message):
+            if message["type"] == "http.response.start":
+                timing = (b"server-timing", request.server_timing().encode())
+                message = {**message, "headers": [*message.get("headers", []), timing]}
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _request.reset(token)
+            DB_QUERIES_PER_REQUEST.observe(request.queries)
+            HTTP_REQUEST_DURATION.observe(
+                perf_counter() - request.started,
+                method=scope["method"],
+                route=request.route or "unmatched",
+            )
@@ -0,0 +1,74 @@
+import json
+from typing import Any, AsyncIterator, List, Mapping
+
+from starlette.responses import JSONResponse, StreamingResponse
+
+from .metrics import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON = "application/x-ndjson"
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    `JSONResponse` rendering straight to bytes with orjson, if it's
+    installed, and with the standard library otherwise.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with span("encode"):
+            return dumps(content)
+
+
+def accepts_ndjson(headers: Mapping[str, str]) -> bool:
+    return NDJSON in headers.get("accept", "")
+
+
+async def _lines(first: List[Any], rows: AsyncIterator[Any]) -> AsyncIterator[bytes]:
+    for row in first:
+        yield dumps(row) + b"\n"
+
+    async for row in rows:
+        yield dumps(row) + b"\n"
+
+
+class NDJSONResponse(StreamingResponse):
+    """
+    Streams rows as newline-delimited JSON, one row per line, without
+    collecting them first.
+    """
+
+    media_type = NDJSON
+
+    first: List[Any]
+
+    @classmethod
+    async def start(cls, rows: AsyncIterator[Any], prefetch: int = 1, **kwargs) -> "NDJSONResponse":
+        """
+        Fetch the first `prefetch` rows before returning the response, so
+        that errors raised by the query, such as a 404, still turn into a
+        proper status, and so that the caller can look at them in `first`,
+        e.g. to link to the next page.
+        """
+        first: List[Any] = []
+
+        while len(first) < prefetch:
+            try:
+                first.append(await rows.__anext__())
+            except StopAsyncIteration:
+                break
+
+        response = cls(_lines(first, rows), **kwargs)
+        response.first = first
+        return response
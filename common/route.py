@@ -2,6 +2,7 @@ import logging
 import sys
 from functools import partial
 from http.client import responses
+from time import perf_counter
 
 from fastapi import status
 from fastapi.responses import JSONResponse
@@ -15,6 +16,8 @@ except ImportError:
 
 import click
 
+from .metrics import current_request, record_span
+
 COLORS = {
     1: partial(click.style, fg="bright_white"),
     2: partial(click.style, fg="green"),
@@ -33,11 +36,13 @@ class LoggingRoute(APIRoute):
         _route_handler = super().get_route_handler()
 
         async def route_handler(request):
-            url = URL(str(request.url)).relative()
-
             if self.DELIMITER:
                 logger.info("――― BEGIN ―――")
 
+            if (stats := current_request()) is not None:
+                stats.route = self.path
+
+            started = perf_counter()
             try:
                 response = await _route_handler(request)
             except ClientResponseError as exc:
@@ -58,12 +63,17 @@ class LoggingRoute(APIRoute):
             else:
                 exc_info = None
 
-            if url.path != "/health":
+            record_span("handler", perf_counter() - started)
+
+            level = logging.ERROR if response.status_code >= 500 else logging.INFO
+
+            # don't style a line nobody is going to see
+            if request.url.path != "/health" and logger.isEnabledFor(level):
                 logger.log(
-                    logging.ERROR if response.status_code >= 500 else logging.INFO,
+                    level,
                     "%6s %s: %s",
                     click.style(request.method, bold=True),
-                    url,
+                    URL(str(request.url)).relative(),
                     COLORS[response.status_code // 100](
                         f"{response.status_code} {responses[response.status_code]}"
                     ),
@@ -73,8 +83,6 @@ class LoggingRoute(APIRoute):
                 if self.DELIMITER:
                     logger.info("―――  END  ―――")
 
-                sys.stdout.flush()
-
             return response
 
         return route_handler
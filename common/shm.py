@@ -0,0 +1,338 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from hashlib import blake2b
+from itertools import islice
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers
+
+from .cache import CacheEntry, CacheKey, MemoryCache, VaryIndex, parse_vary
+
+MAGIC = b"SLAB0002"
+
+# magic, number of buckets, data offset, data size, write head, generation
+HEADER = struct.Struct("<8sQQQQQ")
+# sequence, key hash, generation, record position, record size, expires
+BUCKET = struct.Struct("<QQQQQd")
+# generation, key size, etag size, headers size, body size
+RECORD = struct.Struct("<QIIII")
+
+# how many buckets to look at before giving up
+PROBES = 8
+
+# how many times to re-read a bucket which is being written before treating it as a miss
+RETRIES = 1000
+
+
+def _hash(key: bytes) -> int:
+    # zero marks an empty bucket
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+def _align(size: int) -> int:
+    return (size + 7) & ~7
+
+
+class Slab:
+    """
+    Fixed-size, memory-mapped file shared by all processes on the host. It
+    consists of a header, an open-addressing hash index, and a ring buffer of
+    records.
+
+    Writers serialize on `flock`. Readers never lock: each bucket is guarded by
+    a sequence number, odd while the bucket is being written, so a reader
+    retries if the sequence changed while it was reading. A bucket which stays
+    odd, because its writer died halfway, is treated as a miss until it's
+    written again.
+
+    Records are addressed by their position in the stream of all bytes ever
+    written to the ring, and the write head is advanced before a record is
+    written. Readers copy the record, then check that the head hasn't gone a
+    full lap past it in the meantime; if it did, the ring wrapped around and
+    overwrote the record, and the reader treats it as a miss.
+    """
+
+    def __init__(self, path: str, size: int = 64 * 1024 * 1024, buckets: int = 65536):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        data_offset = _align(HEADER.size + buckets * BUCKET.size)
+        assert size > 2 * data_offset, "slab is too small for the index"
+
+        with self._lock():
+            if os.fstat(self.fd).st_size != size:
+                os.ftruncate(self.fd, size)
+
+            self.mmap = mmap.mmap(self.fd, size)
+
+            # a slab laid out for another size would have readers look past the end of the mapping
+            magic, *layout, _, _ = HEADER.unpack_from(self.mmap, 0)
+            if magic != MAGIC or layout != [buckets, data_offset, size - data_offset]:
+                self.mmap[:data_offset] = bytes(data_offset)
+                HEADER.pack_into(self.mmap, 0, MAGIC, buckets, data_offset, size - data_offset, 0, 0)
+
+    @property
+    def buckets(self) -> int:
+        return HEADER.unpack_from(self.mmap, 0)[1]
+
+    @contextmanager
+    def _lock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _bucket_offset(self, index: int) -> int:
+        return HEADER.size + index * BUCKET.size
+
+    def _read_bucket(self, index: int) -> Optional[Tuple[int, int, int, int, int, float]]:
+        offset = self._bucket_offset(index)
+
+        for _ in range(RETRIES):
+            bucket = BUCKET.unpack_from(self.mmap, offset)
+            if bucket[0] & 1:
+                continue
+
+            if struct.unpack_from("<Q", self.mmap, offset)[0] == bucket[0]:
+                return bucket
+
+        return None
+
+    def _locked_bucket(self, index: int) -> Tuple[int, int, int, int, int, float]:
+        # with the lock held, nobody else is writing, even if the sequence is odd
+        return BUCKET.unpack_from(self.mmap, self._bucket_offset(index))
+
+    def _write_bucket(self, index: int, *fields):
+        offset = self._bucket_offset(index)
+        # round up, in case the previous writer died between the two updates
+        sequence = (struct.unpack_from("<Q", self.mmap, offset)[0] + 1) & ~1
+
+        struct.pack_into("<Q", self.mmap, offset, sequence + 1)
+        BUCKET.pack_into(self.mmap, offset, sequence + 1, *fields)
+        struct.pack_into("<Q", self.mmap, offset, sequence + 2)
+
+    def _probe(self, hash: int):
+        buckets = self.buckets
+        for i in range(PROBES):
+            yield (hash + i) % buckets
+
+    def get(self, key: bytes) -> Optional[Tuple[bytes, bytes, bytes, float]]:
+        """
+        Returns etag, headers and body stored under `key`, and the expiry
+        time, or None.
+        """
+        hash = _hash(key)
+        _, _, data_offset, data_size, *_ = HEADER.unpack_from(self.mmap, 0)
+
+        for index in self._probe(hash):
+            if (bucket := self._read_bucket(index)) is None:
+                continue
+
+            _, bucket_hash, generation, head, size, expires = bucket
+            if bucket_hash != hash:
+                continue
+
+            offset = data_offset + head % data_size
+            record = self.mmap[offset : offset + size]
+
+            # the ring wrapped around while the record was being copied
+            if HEADER.unpack_from(self.mmap, 0)[4] > head + data_size:
+                return None
+
+            if len(record) < RECORD.size:
+                return None
+
+            record_generation, key_size, etag_size, headers_size, body_size = RECORD.unpack_from(record)
+            if record_generation != generation:
+                return None
+
+            position = RECORD.size
+            if record[position : position + key_size] != key:
+                continue
+            position += key_size
+
+            etag = record[position : position + etag_size]
+            position += etag_size
+
+            headers = record[position : position + headers_size]
+            position += headers_size
+
+            body = record[position : position + body_size]
+            return etag, headers, body, expires
+
+        return None
+
+    def put(self, key: bytes, etag: bytes, headers: bytes, body: bytes, expires: float) -> bool:
+        size = _align(RECORD.size + len(key) + len(etag) + len(headers) + len(body))
+        hash = _hash(key)
+
+        with self._lock():
+            magic, buckets, data_offset, data_size, head, generation = HEADER.unpack_from(self.mmap, 0)
+
+            # don't let a single record wipe out a big chunk of the ring
+            if size > data_size // 4:
+                return False
+
+            # records don't wrap around the end of the ring
+            if (cursor := head % data_size) + size > data_size:
+                head += data_size - cursor
+                cursor = 0
+
+            generation += 1
+            offset = data_offset + cursor
+
+            # readers of records about to be overwritten must see they're gone before they're changed
+            HEADER.pack_into(self.mmap, 0, magic, buckets, data_offset, data_size, head + size, generation)
+
+            RECORD.pack_into(self.mmap, offset, generation, len(key), len(etag), len(headers), len(body))
+            position = offset + RECORD.size
+            for part in (key, etag, headers, body):
+                self.mmap[position : position + len(part)] = part
+                position += len(part)
+
+            # reuse the bucket holding the same key, or a free one, or the oldest one; the key may sit
+            # past a free bucket, so it's looked for in all of them, or it would end up in two buckets
+            same, free, oldest, oldest_generation = None, None, None, None
+            for index in self._probe(hash):
+                _, bucket_hash, bucket_generation, *_ = self._locked_bucket(index)
+
+                if bucket_hash == hash:
+                    same = index
+                    break
+
+                if bucket_hash == 0:
+                    free = index if free is None else free
+                elif oldest_generation is None or bucket_generation < oldest_generation:
+                    oldest, oldest_generation = index, bucket_generation
+
+            victim = next(index for index in (same, free, oldest) if index is not None)
+
+            self._write_bucket(victim, hash, generation, head, size, expires)
+
+        return True
+
+    def drop(self, key: bytes) -> bool:
+        hash = _hash(key)
+        dropped = False
+
+        with self._lock():
+            # put keeps a key in one bucket, but an entry served after it was dropped is never harmless
+            for index in self._probe(hash):
+                if self._locked_bucket(index)[1] == hash:
+                    self._write_bucket(index, 0, 0, 0, 0, 0.0)
+                    dropped = True
+
+        return dropped
+
+    def clear(self):
+        with self._lock():
+            for index in range(self.buckets):
+                self._write_bucket(index, 0, 0, 0, 0, 0.0)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+
+def _encode_key(key) -> bytes:
+    return json.dumps(key, separators=(",", ":")).encode()
+
+
+class SharedVaryIndex(VaryIndex):
+    """
+    Keeps the Vary set of each URL in the slab, so that a worker can look up
+    entries stored by other workers.
+    """
+
+    def __init__(self, slab: Slab):
+        super().__init__()
+        self.slab = slab
+
+    def vary(self, url) -> Optional[Tuple[str, ...]]:
+        if found := self.slab.get(_encode_key(["vary", str(url)])):
+            return parse_vary(found[2].decode())
+
+        return None
+
+    def record(self, url, vary_header: str) -> Tuple[str, ...]:
+        vary = parse_vary(vary_header)
+
+        if self.vary(url) != vary:
+            self.slab.put(_encode_key(["vary", str(url)]), b"", b"", ",".join(vary).encode(), float("inf"))
+
+        return vary
+
+    def clear(self):
+        pass
+
+
+class SharedMemoryCache(MemoryCache):
+    """
+    `MemoryCache` keeping entries in a `Slab`, so that all uvicorn workers on
+    the host share them. Entry count is bounded by the number of buckets and
+    bytes by the size of the slab; the oldest entries are overwritten first.
+
+    Subscriptions stay in the process which stored the entry. To drop entries
+    when another worker handles the write, connect workers with a `Bus`. A
+    worker which starts, or restarts, clears the slab, since nothing would
+    drop entries subscribed to by its previous incarnation.
+    """
+
+    # subscriptions checked against the slab on each store, see `_prune`
+    PRUNE_BATCH = 2
+
+    def __init__(self, slab: Slab, max_age: float = 60.0):
+        super().__init__(max_age=max_age)
+        self.slab = slab
+        self.vary = SharedVaryIndex(slab)
+        self.slab.clear()
+
+    def __contains__(self, key: CacheKey):
+        return self.slab.get(_encode_key(key)) is not None
+
+    def clear(self):
+        super().clear()
+        self.slab.clear()
+
+    def _load(self, key: CacheKey) -> Optional[CacheEntry]:
+        if (found := self.slab.get(_encode_key(key))) is None:
+            return None
+
+        etag, headers, body, expires = found
+        raw = [(name.encode(), value.encode()) for name, value in json.loads(headers)]
+        # the slab keeps wall-clock time, since monotonic clocks differ between processes
+        expires = expires - time.time() + time.monotonic()
+        return CacheEntry(etag.decode(), Headers(raw=raw), expires, 0, body)
+
+    def _save(self, key: CacheKey, entry: CacheEntry) -> bool:
+        headers = json.dumps(list(entry.response_headers.items()), separators=(",", ":")).encode()
+        expires = entry.expires - time.monotonic() + time.time()
+        saved = self.slab.put(_encode_key(key), entry.etag.encode(), headers, entry.body, expires)
+
+        self._prune()
+        return saved
+
+    def _prune(self):
+        """
+        Unsubscribe keys whose entries were overwritten in the slab, by this
+        worker or another one. A few subscriptions are checked per store,
+        oldest first, and those still in the slab go to the back of the line,
+        so stale ones can't pile up faster than they're found.
+        """
+        for key in list(islice(self.subscriptions, self.PRUNE_BATCH)):
+            # views subscribe before their response is stored
+            if key in self.inflight or key in self:
+                self.subscriptions[key] = self.subscriptions.pop(key)
+            else:
+                self._unsubscribe(key)
+
+    def _discard(self, key: CacheKey) -> Optional[CacheEntry]:
+        entry = self._load(key)
+        self.slab.drop(_encode_key(key))
+        return entry
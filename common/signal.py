@@ -1,9 +1,9 @@
 from dataclasses import dataclass, field
 from inspect import isawaitable
-from typing import Any, Callable, Dict, Iterable, Set, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 
-def sorted_pairs(L: Iterable[Tuple[str, Any]]) -> Iterable[Tuple[str, Any]]:
+def sorted_pairs(L: Iterable[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
     return sorted(L, key=lambda x: x[0])
 
 
@@ -69,43 +69,94 @@ class Signal:
             (b, 4):
                 (d, 5): {H}
 
-    When publishing, we again sort event items by field name, set the current
-    node `N` to `<root>`, and then for each item `i`:
-     - unconditionally call all callbacks attached to the `N`
-     - if `N` contains a child matching `i`, recurse from `N` set that child
-       and remaining event fields
-     - otherwise, stay at `N` and proceed to the next item
+    When publishing, we again sort event items by field name, and walk the
+    tree with a stack of `(node N, position p)` pairs, starting with
+    `(<root>, 0)`. For each pair popped from the stack:
+     - collect all callbacks attached to `N`
+     - for each event item `i` at position `p` or later, if `N` contains a
+       child matching `i`, push that child with the position right after `i`
 
     Note that a published event may match more than one subscriber's filter,
-    whether they live on the same path through the tree, or not. That's why we
-    call the lookup recursively and *do not* return from the current branch -
-    instead we continue as usual with the current node, until each recursion
-    branch exhausts event fields.
+    whether they live on the same path through the tree, or not. That's why
+    we *do not* stop at the first matching child - each of them gets pushed,
+    until every branch exhausts event fields.
+
+    Callbacks are collected first and called afterwards, each one once, even
+    if it matched more than one event of a batch passed to `publish_many`.
+
+    Cancelling a subscription removes nodes left without any callbacks or
+    children, so that the tree doesn't keep growing as subscribers come and
+    go.
+
+    If `relay` is set, published events are also handed over to it, so that
+    they can be delivered to subscribers in other processes. These events are
+    then fed into `dispatch`, which notifies local subscribers only.
     """
 
     def __init__(self):
         self.root = Node()
+        self.relay: Optional[Callable[[Dict[str, Any]], None]] = None
 
     async def publish(self, event: Dict[str, Any]):
-        async def _publish(node: Node, match: Iterable[Tuple[str, Any]], event: Dict[str, Any]):
-            for callback in set(node.callbacks):
-                result = callback()
-                if isawaitable(result):
-                    await result
+        await self.publish_many([event])
+
+    async def publish_many(self, events: Iterable[Dict[str, Any]]):
+        events = list(events)
+
+        if self.relay is not None:
+            for event in events:
+                self.relay(event)
+
+        await self.dispatch_many(events)
+
+    async def dispatch(self, event: Dict[str, Any]):
+        await self.dispatch_many([event])
+
+    async def dispatch_many(self, events: Iterable[Dict[str, Any]]):
+        # dict rather than set, to call callbacks in the order they matched
+        callbacks: Dict[Callable, None] = {}
+
+        for event in events:
+            self._match(event, callbacks)
+
+        for callback in callbacks:
+            result = callback()
+            if isawaitable(result):
+                await result
+
+    def _match(self, event: Dict[str, Any], callbacks: Dict[Callable, None]):
+        items = sorted_pairs(event.items())
+        stack: List[Tuple[Node, int]] = [(self.root, 0)]
+
+        while stack:
+            node, position = stack.pop()
+            callbacks.update(dict.fromkeys(node.callbacks))
+
+            if not node.children:
+                continue
+
+            for index in range(position, len(items)):
+                if child := node.children.get(items[index]):
+                    stack.append((child, index + 1))
+
+    def subscribe(self, filter: Dict[str, Any], callback: Callable) -> Callable[[], None]:
+        items = sorted_pairs(filter.items())
+        path = [self.root]
 
-            while match:
-                (key, value), *match = match
-                if next := node.children.get((key, value)):
-                    await _publish(next, match, event)
+        for item in items:
+            path.append(path[-1].children.setdefault(item, Node()))
 
-        await _publish(self.root, sorted_pairs(event.items()), event)
+        path[-1].callbacks.add(callback)
 
-    def subscribe(self, filter: Dict[str, Any], callback: Callable):
-        node = self.root
+        def _unsubscribe():
+            path[-1].callbacks.discard(callback)
 
-        for k, v in sorted_pairs(filter.items()):
-            node = node.children.setdefault((k, v), Node())
+            # prune nodes from the leaf up, until one still leads to a subscriber
+            for parent, node, item in reversed(list(zip(path, path[1:], items))):
+                if node.callbacks or node.children:
+                    break
 
-        node.callbacks.add(callback)
+                if parent.children.get(item) is node:
+                    del parent.children[item]
 
-        return lambda: node.callbacks.discard(callback)
+        return _unsubscribe
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# make the services importable without installing them, as their Dockerfiles do with `pip install -e`
+ROOT = Path(__file__).resolve().parent.parent
+
+for service in ("todo-svc", "api-svc"):
+    if (path := str(ROOT / service)) not in sys.path:
+        sys.path.insert(0, path)
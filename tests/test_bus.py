@@ -0,0 +1,168 @@
+import asyncio
+
+from todo_svc.bus import Bus, LocalBroker, LocalTransport, PostgresTransport
+from todo_svc.signal import Signal
+
+
+async def _workers(count):
+    broker = LocalBroker()
+    workers = []
+
+    for _ in range(count):
+        signal = Signal()
+        bus = Bus(LocalTransport(broker), linger=0)
+        bus.attach("lists", signal)
+        await bus.start()
+        workers.append((bus, signal))
+
+    return broker, workers
+
+
+def test_bus_delivers_to_other_workers():
+    async def _test():
+        _, workers = await _workers(3)
+        received = [[] for _ in workers]
+
+        for (_, signal), events in zip(workers, received):
+            signal.subscribe(dict(list_id="a"), lambda events=events: events.append("a"))
+
+        await workers[0][1].publish(dict(list_id="a", name="foo"))
+        await workers[0][1].publish(dict(list_id="b", name="bar"))
+        await asyncio.sleep(0.01)
+
+        for bus, _ in workers:
+            await bus.stop()
+
+        return received
+
+    assert asyncio.run(_test()) == [["a"], ["a"], ["a"]]
+
+
+def test_bus_coalesces_events():
+    async def _test():
+        broker, workers = await _workers(2)
+        payloads = []
+
+        send = broker.send
+
+        async def _send(payload):
+            payloads.append(payload)
+            await send(payload)
+
+        broker.send = _send
+
+        for _ in range(100):
+            await workers[0][1].publish(dict(list_id="a", name="foo"))
+        await asyncio.sleep(0.01)
+
+        for bus, _ in workers:
+            await bus.stop()
+
+        return payloads
+
+    payloads = asyncio.run(_test())
+    assert len(payloads) == 1
+    assert payloads[0].count(b"foo") == 1
+
+
+class _Connection:
+    def __init__(self):
+        self.listeners = []
+        self.terminated = []
+
+    async def add_listener(self, channel, listener):
+        self.listeners.append(listener)
+
+    def add_termination_listener(self, listener):
+        self.terminated.append(listener)
+
+    def drop(self):
+        for listener in self.terminated:
+            listener(self)
+
+    def terminate(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class _Transport(PostgresTransport):
+    def __init__(self, failures):
+        super().__init__("postgresql://", keepalive=60)
+        self.failures = failures
+        self.connections = []
+
+    async def _connect(self):
+        if self.connections and self.failures:
+            self.failures -= 1
+            raise OSError("connection refused")
+
+        self.connections.append(connection := _Connection())
+        await connection.add_listener(self.channel, self._listener)
+        connection.add_termination_listener(self._terminated)
+        self.connection = connection
+
+
+def test_postgres_transport_reconnects_and_resyncs():
+    async def _test():
+        transport = _Transport(failures=2)
+        bus = Bus(transport, linger=0)
+        signal = Signal()
+        bus.attach("lists", signal)
+
+        resyncs, received = [], []
+        bus.on_resync(lambda: resyncs.append(len(transport.connections)))
+        signal.subscribe(dict(list_id="a"), lambda: received.append("a"))
+        await bus.start()
+
+        transport.connections[0].drop()
+        await asyncio.sleep(0.5)
+
+        # delivered over the new connection
+        (listener,) = transport.connections[-1].listeners
+        listener(None, 0, "invalidate", '{"origin":"other","events":[["lists",{"list_id":"a"}]]}')
+        await asyncio.sleep(0.01)
+
+        await bus.stop()
+        return resyncs, received
+
+    assert asyncio.run(_test()) == ([2], ["a"])
+
+
+class _FlakyTransport(LocalTransport):
+    def __init__(self, broker, failures):
+        super().__init__(broker)
+        self.failures = failures
+
+    async def send(self, payload):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("LISTEN connection is down")
+
+        await super().send(payload)
+
+
+def test_bus_sends_again_after_failure():
+    async def _test():
+        broker = LocalBroker()
+        sender = Bus(_FlakyTransport(broker, failures=1), linger=0, retry=0.01)
+        receiver = Bus(LocalTransport(broker), linger=0)
+
+        signals = [Signal(), Signal()]
+        for bus, signal in zip((sender, receiver), signals):
+            bus.attach("lists", signal)
+            await bus.start()
+
+        received = []
+        signals[1].subscribe(dict(list_id="a"), lambda: received.append("a"))
+
+        await signals[0].publish(dict(list_id="a", name="foo"))
+        await asyncio.sleep(0.05)
+
+        for bus in (sender, receiver):
+            await bus.stop()
+
+        return received, sender.pending
+
+    assert asyncio.run(_test()) == (["a"], {})
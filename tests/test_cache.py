@@ -1,9 +1,49 @@
+import importlib
+import os
+import socket
+import threading
+import time
 from secrets import token_urlsafe
 
 import pytest
 import requests
 
 
+@pytest.fixture(scope="session", autouse=True)
+def api_svc():
+    """
+    Unless something already listens on port 8080, e.g. docker-compose, run
+    api-svc there in a background thread, with todo-svc in-process. todo-svc
+    still needs Postgres, configured via DB_HOST, DB_USER, DB_PASSWORD and
+    DB_NAME.
+    """
+    with socket.socket() as sock:
+        if sock.connect_ex(("localhost", 8080)) == 0:
+            yield
+            return
+
+    import uvicorn
+
+    # read when the app is built, on import
+    os.environ["TODO_SVC_ASGI"] = "todo_svc:asgi"
+    app = importlib.import_module("api_svc").asgi
+
+    server = uvicorn.Server(uvicorn.Config(app, host="localhost", port=8080, log_config=None, lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    while not server.started:
+        if not thread.is_alive():
+            pytest.fail("api-svc failed to start, see the log above")
+
+        time.sleep(0.05)
+
+    yield
+
+    server.should_exit = True
+    thread.join()
+
+
 @pytest.fixture
 def email():
     return "test@user.com"
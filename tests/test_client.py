@@ -0,0 +1,196 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from yarl import URL
+
+client = pytest.importorskip("api_svc.client")
+context = pytest.importorskip("api_svc.context")
+NDJSON = pytest.importorskip("api_svc.response").NDJSON
+
+KEY = (("GET", "http://todo-svc/lists/1", (), ()),)
+
+
+def test_single_flight_coalesces_calls():
+    calls = []
+
+    async def _work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def _test():
+        flights = client.SingleFlight()
+        results = await asyncio.gather(*(flights(KEY, _work) for _ in range(10)))
+        return results, flights.flights
+
+    results, flights = asyncio.run(_test())
+    assert results == ["result"] * 10
+    assert calls == [1]
+    assert flights == {}
+
+
+def test_single_flight_propagates_errors_to_all_callers():
+    async def _work():
+        await asyncio.sleep(0.01)
+        raise ConnectionError("upstream is down")
+
+    async def _test():
+        flights = client.SingleFlight()
+        results = await asyncio.gather(*(flights(KEY, _work) for _ in range(3)), return_exceptions=True)
+
+        # the failure isn't remembered, the next call tries again
+        assert KEY not in flights.flights
+        return results
+
+    results = asyncio.run(_test())
+    assert [type(result) for result in results] == [ConnectionError] * 3
+
+
+def test_single_flight_survives_cancelled_leader():
+    calls = []
+
+    async def _work():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def _test():
+        flights = client.SingleFlight()
+        leader = asyncio.create_task(flights(KEY, _work))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights(KEY, _work))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+        return await follower
+
+    assert asyncio.run(_test()) == "result"
+    assert calls == [1]
+
+
+def test_cold_fetches_share_a_flight_across_correlation_ids():
+    todo_svc = URL("http://todo-svc")
+    calls = []
+
+    app = FastAPI()
+
+    @app.get("/lists/{list_id}")
+    async def get_list(list_id: str, request: Request):
+        calls.append(request.headers["x-correlation-id"])
+        await asyncio.sleep(0.01)
+        return dict(list_id=list_id)
+
+    async def _fetch(correlation_id):
+        context.update_headers(**{"x-user": "a@b.c", "x-correlation-id": correlation_id})
+        return (await client.fetch(todo_svc / "lists" / "1")).json()
+
+    async def _test():
+        pool = client.SessionPool(apps={(todo_svc.host, todo_svc.port): app})
+        client._session.set(await pool.start())
+
+        try:
+            return await asyncio.gather(*(_fetch(str(i)) for i in range(5)))
+        finally:
+            await pool.stop()
+
+    assert asyncio.run(_test()) == [dict(list_id="1")] * 5
+    assert len(calls) == 1
+
+
+def test_fetch_follows_cache_control():
+    todo_svc = URL("http://todo-svc")
+    calls = []
+
+    app = FastAPI()
+
+    @app.get("/lists/{list_id}")
+    async def get_list(list_id: str, response: Response):
+        calls.append(list_id)
+        if calls.count("down") > 1:
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        cache_control = "max-age=60" if list_id == "fresh" else "max-age=0, stale-if-error=60"
+        response.headers["cache-control"] = cache_control
+        response.headers["etag"] = '"1"'
+        return dict(list_id=list_id)
+
+    async def _test():
+        pool = client.SessionPool(apps={(todo_svc.host, todo_svc.port): app})
+        client._session.set(await pool.start())
+
+        try:
+            list_ids = ["fresh", "fresh", "down", "down"]
+            return [(await client.fetch(todo_svc / "lists" / list_id)).json() for list_id in list_ids]
+        finally:
+            await pool.stop()
+
+    assert asyncio.run(_test()) == [dict(list_id="fresh")] * 2 + [dict(list_id="down")] * 2
+    # within max-age, the second fetch doesn't reach upstream; past it, an error is answered from the cache
+    assert calls == ["fresh", "down", "down"]
+
+
+def test_stream_relays_headers_and_releases_unsent_response():
+    todo_svc = URL("http://todo-svc")
+
+    app = FastAPI()
+
+    @app.get("/lists")
+    async def get_lists():
+        link = '</lists?after=1&limit=1>; rel="next"'
+        headers = {"link": link, "vary": "x-role, accept"}
+        return StreamingResponse(iter([b'{"list_id":"1"}\n']), media_type=NDJSON, headers=headers)
+
+    async def _receive():
+        await asyncio.Event().wait()
+
+    async def _disconnected(message):
+        raise OSError("client went away")
+
+    async def _test():
+        pool = client.SessionPool(apps={(todo_svc.host, todo_svc.port): app})
+        client._session.set(await pool.start())
+
+        try:
+            streamed = await client.stream(todo_svc / "lists", headers={"accept": NDJSON})
+            with pytest.raises(OSError):
+                await streamed(dict(type="http"), _receive, _disconnected)
+
+            return streamed.headers, streamed.upstream.closed
+        finally:
+            await pool.stop()
+
+    headers, released = asyncio.run(_test())
+    assert headers["link"] == '</lists?after=1&limit=1>; rel="next"'
+    assert headers["content-type"] == NDJSON
+    assert headers["vary"] == client.VARY
+    assert released
+
+
+def test_concurrent_starts_open_one_session():
+    todo_svc = URL("http://todo-svc")
+    startups = []
+
+    app = FastAPI()
+
+    @app.on_event("startup")
+    async def startup():
+        startups.append(1)
+        await asyncio.sleep(0.01)
+
+    async def _test():
+        pool = client.SessionPool(apps={(todo_svc.host, todo_svc.port): app})
+
+        try:
+            sessions = await asyncio.gather(*(pool.start() for _ in range(5)))
+        finally:
+            await pool.stop()
+
+        return {id(session) for session in sessions}
+
+    assert len(asyncio.run(_test())) == 1
+    assert startups == [1]
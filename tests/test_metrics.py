@@ -0,0 +1,25 @@
+from todo_svc.metrics import Counter, Histogram, Registry
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    hits = Counter("hits_total", "Hits", registry=registry)
+    queries = Histogram("queries", "Queries", buckets=(1, 5), registry=registry)
+
+    hits.inc(route="/lists")
+    hits.inc(2, route="/lists")
+    for value in (0, 3, 8):
+        queries.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP hits_total Hits",
+        "# TYPE hits_total counter",
+        'hits_total{route="/lists"} 3',
+        "# HELP queries Queries",
+        "# TYPE queries histogram",
+        'queries_bucket{le="1"} 1',
+        'queries_bucket{le="5"} 2',
+        'queries_bucket{le="+Inf"} 3',
+        "queries_sum 11",
+        "queries_count 3",
+    ]
@@ -0,0 +1,112 @@
+import multiprocessing
+
+from starlette.datastructures import Headers
+
+from todo_svc.shm import HEADER, SharedMemoryCache, Slab, _hash
+
+
+def _store(path):
+    cache = SharedMemoryCache(Slab(path, size=1024 * 1024, buckets=1024))
+    cache.store("GET", "http://todo-svc/lists", {"x-user": "a"}, '"etag"', Headers({"vary": "x-user"}), b"[]")
+
+
+def test_shared_between_processes(tmp_path):
+    path = str(tmp_path / "slab")
+    cache = SharedMemoryCache(Slab(path, size=1024 * 1024, buckets=1024))
+
+    worker = multiprocessing.Process(target=_store, args=(path,))
+    worker.start()
+    worker.join()
+
+    entry = cache.get("GET", "http://todo-svc/lists", {"x-user": "a"})
+    assert entry.etag == '"etag"'
+    assert bytes(entry.body) == b"[]"
+
+    assert cache.get("GET", "http://todo-svc/lists", {"x-user": "b"}) is None
+
+
+def test_overwritten_when_full(tmp_path):
+    cache = SharedMemoryCache(Slab(str(tmp_path / "slab"), size=1024 * 1024, buckets=1024))
+
+    for i in range(4096):
+        cache.store("GET", f"http://todo-svc/lists/{i}", {}, '"etag"', Headers(), b"x" * 256)
+
+    assert cache.get("GET", "http://todo-svc/lists/0", {}) is None
+    assert bytes(cache.get("GET", "http://todo-svc/lists/4095", {}).body) == b"x" * 256
+
+
+def test_half_written_bucket_is_a_miss(tmp_path):
+    slab = Slab(str(tmp_path / "slab"), size=1024 * 1024, buckets=1024)
+    slab.put(b"key", b"etag", b"[]", b"body", float("inf"))
+
+    # a writer died between bumping the sequence and finishing the bucket
+    (index,) = [index for index in range(1024) if slab._locked_bucket(index)[1]]
+    offset = slab._bucket_offset(index)
+    sequence = int.from_bytes(slab.mmap[offset : offset + 8], "little")
+    slab.mmap[offset : offset + 8] = (sequence + 1).to_bytes(8, "little")
+
+    assert slab.get(b"key") is None
+
+    slab.put(b"key", b"etag", b"[]", b"new", float("inf"))
+    assert slab.get(b"key")[2] == b"new"
+
+
+class _WrappingSlab(Slab):
+    def _read_bucket(self, index):
+        bucket = super()._read_bucket(index)
+
+        # another process fills the whole ring while this one is reading
+        for i in range(64):
+            self.put(f"other{i}".encode(), b"", b"", b"x" * 32 * 1024, float("inf"))
+
+        return bucket
+
+
+def test_overwritten_while_reading_is_a_miss(tmp_path):
+    slab = _WrappingSlab(str(tmp_path / "slab"), size=1024 * 1024, buckets=1024)
+    slab.put(b"key", b"etag", b"[]", b"body", float("inf"))
+
+    assert slab.get(b"key") is None
+
+
+def test_dropped_key_doesnt_come_back(tmp_path):
+    slab = Slab(str(tmp_path / "slab"), size=1024 * 1024, buckets=1024)
+
+    # another key taking the bucket the key would otherwise go to
+    home = _hash(b"key") % 1024
+    other = next(key for i in range(100000) if _hash(key := f"other{i}".encode()) % 1024 == home)
+
+    slab.put(other, b"", b"", b"", float("inf"))
+    slab.put(b"key", b"old", b"[]", b"old", float("inf"))
+    slab.drop(other)
+
+    slab.put(b"key", b"new", b"[]", b"new", float("inf"))
+    assert slab.drop(b"key")
+    assert slab.get(b"key") is None
+
+
+def test_reopened_with_another_size(tmp_path):
+    path = str(tmp_path / "slab")
+    Slab(path, size=2 * 1024 * 1024, buckets=1024).put(b"key", b"etag", b"[]", b"body", float("inf"))
+
+    slab = Slab(path, size=1024 * 1024, buckets=1024)
+    assert slab.get(b"key") is None
+    assert HEADER.unpack_from(slab.mmap, 0)[3] == 1024 * 1024 - HEADER.unpack_from(slab.mmap, 0)[2]
+
+
+class _Model:
+    @staticmethod
+    def subscribe(callback, **filter):
+        return lambda: None
+
+
+def test_forgets_subscriptions_of_overwritten_entries(tmp_path):
+    cache = SharedMemoryCache(Slab(str(tmp_path / "slab"), size=1024 * 1024, buckets=1024))
+
+    for i in range(4096):
+        key = cache.record("GET", f"http://todo-svc/lists/{i}", {}, Headers())
+        cache.drop_on(key, _Model)
+        cache.put(key, '"etag"', Headers(), b"x" * 256)
+
+    # no more than there are buckets are still in the slab, and stale ones are found as fast as they appear
+    assert len(cache.subscriptions) < 1024
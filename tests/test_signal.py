@@ -0,0 +1,50 @@
+import asyncio
+
+from todo_svc.signal import Signal
+
+
+def test_signal_matches_all_filters_contained_in_event():
+    signal = Signal()
+    called = []
+
+    for name, filter in dict(
+        F=dict(a=1, b=2, c=3),
+        G=dict(a=1, b=3),
+        H=dict(b=4, d=5),
+        I=dict(a=1, b=2),
+        J=dict(),
+        K=dict(c=3),
+    ).items():
+        signal.subscribe(filter, lambda name=name: called.append(name))
+
+    asyncio.run(signal.publish(dict(a=1, b=2, c=3, d=5)))
+
+    assert sorted(called) == ["F", "I", "J", "K"]
+
+
+def test_signal_publish_many_calls_each_callback_once():
+    signal = Signal()
+    called = []
+
+    signal.subscribe(dict(list_id="a"), lambda: called.append("a"))
+    signal.subscribe(dict(list_id="b"), lambda: called.append("b"))
+
+    asyncio.run(signal.publish_many([dict(list_id="a", entry_id=str(i)) for i in range(100)]))
+
+    assert called == ["a"]
+
+
+def test_signal_unsubscribe_prunes_empty_nodes():
+    signal = Signal()
+
+    keep = signal.subscribe(dict(a=1), lambda: None)
+    unsubscribes = [signal.subscribe(dict(a=1, b=i), lambda: None) for i in range(100)]
+
+    for unsubscribe in unsubscribes:
+        unsubscribe()
+
+    assert list(signal.root.children) == [("a", 1)]
+    assert not signal.root.children[("a", 1)].children
+
+    keep()
+    assert not signal.root.children
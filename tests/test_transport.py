@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from aiohttp import ClientResponseError
+from fastapi import FastAPI, HTTPException, Request, status
+from yarl import URL
+
+client = pytest.importorskip("api_svc.client")
+cache = pytest.importorskip("api_svc.cache")
+signal = pytest.importorskip("api_svc.signal")
+
+TODO_SVC = URL("http://todo-svc")
+
+
+class TodoList:
+    CHANGE = signal.Signal()
+
+    @classmethod
+    def subscribe(cls, callback, **filter):
+        return cls.CHANGE.subscribe(filter, callback)
+
+
+def todo_svc(calls):
+    response_cache = cache.MemoryCache()
+
+    app = FastAPI()
+    app.add_middleware(cache.CacheMiddleware, cache=response_cache)
+
+    @app.on_event("startup")
+    async def startup():
+        calls.append("startup")
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        calls.append("shutdown")
+
+    @app.get("/lists/{list_id}")
+    async def get_list(list_id: str, request: Request, cache_key=response_cache.vary_on("x-user")):
+        response_cache.drop_on(cache_key, TodoList, list_id=list_id)
+        calls.append(request.headers.get("x-user"))
+        if list_id == "missing":
+            raise HTTPException(status.HTTP_404_NOT_FOUND)
+
+        return dict(list_id=list_id)
+
+    return app
+
+
+def test_in_process_transport():
+    calls = []
+
+    async def _test():
+        pool = client.SessionPool(apps={(TODO_SVC.host, TODO_SVC.port): todo_svc(calls)})
+        session = await pool.start()
+
+        try:
+            responses = []
+            for _ in range(2):
+                async with session.get(TODO_SVC / "lists" / "1", headers={"x-user": "a@b.c"}) as response:
+                    responses.append((response.status, response.headers["etag"], await response.json()))
+
+            with pytest.raises(ClientResponseError) as error:
+                async with session.get(TODO_SVC / "lists" / "missing"):
+                    pass
+        finally:
+            await pool.stop()
+
+        return responses, error.value.status
+
+    responses, error = asyncio.run(_test())
+
+    # the second request is answered with a 304 by the middleware, and the client serves its cached response
+    assert responses[0] == responses[1]
+    assert responses[0][0] == 200 and responses[0][2] == dict(list_id="1")
+    assert error == 404
+    assert calls == ["startup", "a@b.c", None, "shutdown"]
+
+
+def test_in_process_startup_failure():
+    app = FastAPI()
+
+    @app.on_event("startup")
+    async def startup():
+        raise ConnectionRefusedError("database is down")
+
+    async def _test():
+        pool = client.SessionPool(apps={(TODO_SVC.host, TODO_SVC.port): app})
+        with pytest.raises(RuntimeError, match="database is down"):
+            await pool.start()
+
+        return pool.session
+
+    assert asyncio.run(_test()) is None
@@ -0,0 +1 @@
+../../common/bus.py
\ No newline at end of file
@@ -21,13 +21,29 @@ Model: DeclarativeMeta = declarative_base()
 
 class TodoList(CrudMixin, Model):
     __tablename__ = "lists"
+    __serialized__ = ("collaborators", "entries")
 
     list_id = Column(Text, primary_key=True)
     name = Column(Text, nullable=False)
 
-    collaborators = relationship("Collaborator", lazy="joined", cascade="all, delete-orphan", backref="list")
-
-    entries = relationship("TodoEntry", lazy="joined", cascade="all, delete-orphan", backref="list")
+    # each collection in a separate query, rather than joining both into collaborators × entries rows;
+    # queries which don't need them override it, see CrudMixin.select. Ordered, so that the same data always
+    # renders to the same body, and so to the same ETag.
+    collaborators = relationship(
+        "Collaborator",
+        lazy="selectin",
+        cascade="all, delete-orphan",
+        backref="list",
+        order_by="Collaborator.email",
+    )
+
+    entries = relationship(
+        "TodoEntry",
+        lazy="selectin",
+        cascade="all, delete-orphan",
+        backref="list",
+        order_by="TodoEntry.entry_id",
+    )
 
 
 class TodoEntry(CrudMixin, Model):
@@ -1,20 +1,30 @@
 import logging
 import logging.config
+import os
 from secrets import token_hex
-from typing import List
+from typing import List, Optional
 
 from alembic.command import upgrade as alembic_upgrade
 from alembic.config import Config as alembic_config
-from fastapi import Depends, FastAPI, exceptions, responses, status
-from fastapi_async_sqlalchemy import SQLAlchemyMiddleware
+from fastapi import Depends, FastAPI, Query, Request, exceptions, responses, status
 from pkg_resources import resource_filename
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import create_async_engine
 
+from todo_svc.bus import Bus, MulticastTransport, PostgresTransport
+from todo_svc.cache import CacheKey, CacheMiddleware, MemoryCache, etag
 from todo_svc.context import RequestHeadersMiddleware, current_headers
+from todo_svc.crud import CHANGE, TimedSQLAlchemyMiddleware
 from todo_svc.database import DB_URL, Collaborator, TodoEntry, TodoList
 from todo_svc.log_config import LOG_CONFIG
+from todo_svc.metrics import CONTENT_TYPE, REGISTRY, RequestMetricsMiddleware
+from todo_svc.response import FastJSONResponse, NDJSONResponse, accepts_ndjson
 from todo_svc.route import LoggingRoute
+from todo_svc.shm import SharedMemoryCache, Slab
+
+
+# columns entry views serve, in both JSON and NDJSON; the same as api-svc's TodoEntry
+ENTRY_COLUMNS = (TodoEntry.entry_id, TodoEntry.text)
 
 
 class CreateTodoList(BaseModel):
@@ -48,17 +58,124 @@ def todo_list_role():
     return Depends(_todo_list_role)
 
 
+def next_page(request: Request, response: responses.Response, rows: int, limit: Optional[int], after: str):
+    # keyset pagination: the next page starts right after the last key of this one
+    if limit is not None and rows == limit:
+        url = request.url.include_query_params(after=after)
+        response.headers["link"] = f'<{url.path}?{url.query}>; rel="next"'
+
+
+async def ndjson_response(
+    request: Request, response: responses.Response, rows, limit: Optional[int], key: str
+) -> NDJSONResponse:
+    # A page is read whole before it's sent, so that it can link to the next one, which starts after its
+    # last `key`; `limit` bounds its size. Without a limit there's no next page, and rows are streamed.
+    streamed = await NDJSONResponse.start(rows, prefetch=limit or 1)
+
+    if streamed.first:
+        next_page(request, response, len(streamed.first), limit, streamed.first[-1][key])
+
+    streamed.headers.raw.extend(response.headers.raw)
+    return streamed
+
+
+def json_response(response: responses.Response, content) -> FastJSONResponse:
+    # Returned as is, FastAPI doesn't run it through jsonable_encoder before it's encoded. Headers set on
+    # `response` by dependencies and the view, e.g. Vary and Link, are carried over like FastAPI would.
+    rendered = FastJSONResponse(content)
+    rendered.headers.raw.extend(response.headers.raw)
+    return rendered
+
+
+def representation(request: Request, content, vary: str) -> responses.Response:
+    # `Prefer: return=representation` gets the body a GET would return, with its ETag, instead of a redirect
+    response = FastJSONResponse(content)
+    response.headers["etag"] = etag(response.body)
+    response.headers["vary"] = vary
+    response.headers["content-location"] = request.url.path
+    response.headers["preference-applied"] = "return=representation"
+    return response
+
+
+def prefers_representation(request: Request) -> bool:
+    return "return=representation" in request.headers.get("prefer", "")
+
+
+async def current_todo_list(list_id: str, **_) -> bytes:
+    todo_list = await TodoList.get(TodoList.list_id == list_id)
+    return FastJSONResponse(todo_list.to_dict()).body
+
+
+async def current_todo_entry(list_id: str, entry_id: str, **_) -> bytes:
+    entry = await TodoEntry.get(
+        TodoEntry.list_id == list_id, TodoEntry.entry_id == entry_id, columns=ENTRY_COLUMNS
+    )
+    return FastJSONResponse(entry).body
+
+
+def invalidation_bus() -> Optional[Bus]:
+    transport = os.getenv("INVALIDATION_BUS")
+
+    if transport == "postgres":
+        return Bus(PostgresTransport(str(DB_URL.with_scheme("postgresql"))))
+
+    if transport == "multicast":
+        return Bus(MulticastTransport())
+
+    return None
+
+
+def response_cache() -> MemoryCache:
+    # ETags are still computed, but nothing is kept, so every request reaches the view
+    if os.getenv("RESPONSE_CACHE") == "off":
+        return MemoryCache(max_entries=0)
+
+    # entries are served until they expire, even after a write changed them; for benchmarks only
+    if os.getenv("CACHE_INVALIDATION") == "off":
+        return MemoryCache(max_age=3600, invalidate=False)
+
+    # share entries between uvicorn workers, e.g. CACHE_SLAB=/dev/shm/todo-svc
+    if path := os.getenv("CACHE_SLAB"):
+        # a write only drops entries stored by the worker which handled it, unless workers relay changes
+        if not os.getenv("INVALIDATION_BUS"):
+            raise RuntimeError("CACHE_SLAB requires INVALIDATION_BUS to drop entries stored by other workers")
+
+        return SharedMemoryCache(Slab(path), max_age=3600)
+
+    return MemoryCache(max_age=3600)
+
+
 def todo_svc() -> FastAPI:
     logging.config.dictConfig(LOG_CONFIG)
 
-    app = FastAPI()
+    cache = response_cache()
+
+    app = FastAPI(default_response_class=FastJSONResponse)
     app.router.route_class = LoggingRoute
     app.add_middleware(
-        SQLAlchemyMiddleware,
+        TimedSQLAlchemyMiddleware,
         db_url=str(DB_URL),
         commit_on_exit=True,
     )
+    # Clients may keep serving a response for a minute when todo-svc fails. Reusing it without asking, via
+    # max-age or stale-while-revalidate, would let them miss their own writes, so it's opt-in.
+    app.add_middleware(
+        CacheMiddleware,
+        cache=cache,
+        cache_control=os.getenv("CACHE_CONTROL", "max-age=0, stale-if-error=60"),
+    )
     app.add_middleware(RequestHeadersMiddleware)
+    app.add_middleware(RequestMetricsMiddleware)
+
+    if bus := invalidation_bus():
+        for model in (TodoList, TodoEntry, Collaborator):
+            bus.attach(model.__tablename__, CHANGE[model])
+
+        # invalidations might have been missed, so nothing cached can be trusted anymore
+        bus.on_resync(cache.clear)
+
+        app.on_event("startup")(bus.start)
+        app.on_event("shutdown")(bus.stop)
 
     @app.on_event("startup")
     async def run_migrations():
@@ -73,11 +190,38 @@ def todo_svc() -> FastAPI:
             await connection.run_sync(upgrade, config)
 
     @app.get("/lists")
-    async def get_todo_lists(response: responses.Response):
+    async def get_todo_lists(
+        request: Request,
+        response: responses.Response,
+        after: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1),
+        cache_key: CacheKey = cache.vary_on("x-user", "accept"),
+    ):
         user = current_headers().get("x-user")
-        todo_lists = await TodoList.select(TodoList.collaborators.any(Collaborator.email == user))
 
-        return todo_lists
+        args = [TodoList.collaborators.any(Collaborator.email == user)]
+        if after is not None:
+            args.append(TodoList.list_id > after)
+        page = dict(columns=(TodoList.list_id, TodoList.name), order_by=(TodoList.list_id,), limit=limit)
+
+        # streamed responses aren't cached, so there's nothing to drop
+        if accepts_ndjson(request.headers):
+            return await ndjson_response(request, response, TodoList.stream(*args, **page), limit, "list_id")
+
+        # we don't know which lists to watch until we read them
+        unsubscribe = cache.drop_on(cache_key, TodoList)
+        cache.drop_on(cache_key, Collaborator, email=user)
+
+        todo_lists = await TodoList.select(*args, **page)
+
+        for todo_list in todo_lists:
+            cache.drop_on(cache_key, TodoList, list_id=todo_list["list_id"])
+        unsubscribe()
+
+        if todo_lists:
+            next_page(request, response, len(todo_lists), limit, todo_lists[-1]["list_id"])
+
+        return json_response(response, todo_lists)
 
     @app.post(
         "/lists",
@@ -94,38 +238,56 @@ def todo_svc() -> FastAPI:
         "/lists/{list_id}",
         dependencies=[todo_list_role()],
     )
-    async def get_todo_list(list_id: str):
+    async def get_todo_list(
+        list_id: str, response: responses.Response, cache_key: CacheKey = cache.vary_on("x-role")
+    ):
+        cache.drop_on(cache_key, TodoList, list_id=list_id)
+        cache.drop_on(cache_key, Collaborator, list_id=list_id)
+        cache.drop_on(cache_key, TodoEntry, list_id=list_id)
+
         todo_list = await TodoList.get(TodoList.list_id == list_id)
 
-        return todo_list
+        return json_response(response, todo_list.to_dict())
 
     @app.patch(
         "/lists/{list_id}",
         response_class=responses.RedirectResponse,
         status_code=status.HTTP_303_SEE_OTHER,
-        dependencies=[todo_list_role()],
+        dependencies=[todo_list_role(), cache.if_match(current_todo_list)],
     )
-    async def patch_todo_list(list_id: str, update_todo_list: CreateTodoList):
+    async def patch_todo_list(request: Request, list_id: str, update_todo_list: CreateTodoList):
         await TodoList.update(TodoList.list_id == list_id, **update_todo_list.dict(exclude_none=True))
+
+        if prefers_representation(request):
+            todo_list = await TodoList.get(TodoList.list_id == list_id)
+            return representation(request, todo_list.to_dict(), "x-role")
+
         return f"/lists/{list_id}"
 
     @app.delete(
         "/lists/{list_id}",
         status_code=status.HTTP_204_NO_CONTENT,
-        dependencies=[todo_list_role()],
+        dependencies=[todo_list_role(), cache.if_match(current_todo_list)],
     )
     async def delete_todo_list(list_id: str):
         return await TodoList.delete(TodoList.list_id == list_id)
 
     @app.get(
         "/lists/{list_id}/collaborators",
-        response_model=List[CreateCollaborator],
         dependencies=[todo_list_role()],
     )
-    async def get_collaborators(list_id: str):
-        collaborators = await Collaborator.select(Collaborator.list_id == list_id)
+    async def get_collaborators(
+        list_id: str, response: responses.Response, cache_key: CacheKey = cache.vary_on("x-role")
+    ):
+        cache.drop_on(cache_key, TodoList, list_id=list_id)
+        cache.drop_on(cache_key, Collaborator, list_id=list_id)
+
+        collaborators = await Collaborator.select(
+            Collaborator.list_id == list_id,
+            columns=(Collaborator.email, Collaborator.role),
+        )
 
-        return collaborators
+        return json_response(response, collaborators)
 
     @app.patch(
         "/lists/{list_id}/collaborators",
@@ -134,19 +296,23 @@ def todo_svc() -> FastAPI:
         dependencies=[todo_list_role()],
     )
     async def patch_collaborators(list_id: str, create_collaborators: List[CreateCollaborator]):
-        for user in create_collaborators:
-            await Collaborator.merge(
-                dict(list_id=list_id, email=user.email),
-                role=user.role,
-            )
+        await Collaborator.merge_many(
+            ("list_id", "email"),
+            [dict(list_id=list_id, email=user.email, role=user.role) for user in create_collaborators],
+        )
 
         return f"/lists/{list_id}/collaborators"
 
     @app.get("/lists/{list_id}/collaborators/{email}")
-    async def get_collaborator(list_id: str, email: str):
+    async def get_collaborator(
+        list_id: str, email: str, response: responses.Response, cache_key: CacheKey = cache.vary_on()
+    ):
+        cache.drop_on(cache_key, TodoList, list_id=list_id)
+        cache.drop_on(cache_key, Collaborator, list_id=list_id, email=email)
+
         user = await Collaborator.get(Collaborator.list_id == list_id, Collaborator.email == email)
 
-        return user
+        return json_response(response, user.to_dict())
 
     @app.delete(
         "/lists/{list_id}/collaborators",
@@ -155,10 +321,12 @@ def todo_svc() -> FastAPI:
         dependencies=[todo_list_role()],
     )
     async def delete_collaborators(list_id: str, delete_collaborators: List[str]):
-        for email in delete_collaborators:
-            await Collaborator.delete(
-                Collaborator.list_id == list_id, Collaborator.email == email, Collaborator.role != "owner"
-            )
+        await Collaborator.delete_many(
+            Collaborator.email,
+            delete_collaborators,
+            Collaborator.list_id == list_id,
+            Collaborator.role != "owner",
+        )
 
         return f"/lists/{list_id}/collaborators"
 
@@ -166,11 +334,34 @@ def todo_svc() -> FastAPI:
         "/lists/{list_id}/entries",
         dependencies=[todo_list_role()],
     )
-    async def get_entries(list_id: str):
-        await TodoList.get(TodoList.list_id == list_id)
-        entries = await TodoEntry.select(TodoEntry.list_id == list_id)
+    async def get_entries(
+        list_id: str,
+        request: Request,
+        response: responses.Response,
+        after: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1),
+        cache_key: CacheKey = cache.vary_on("x-role", "accept"),
+    ):
+        filter = [TodoEntry.entry_id > after] if after is not None else []
+        page = dict(filter=filter, order_by=(TodoEntry.entry_id,), limit=limit)
+
+        if accepts_ndjson(request.headers):
+            rows = TodoEntry.stream_within(
+                TodoList, TodoList.list_id == list_id, columns=ENTRY_COLUMNS, **page
+            )
+            return await ndjson_response(request, response, rows, limit, "entry_id")
+
+        cache.drop_on(cache_key, TodoList, list_id=list_id)
+        cache.drop_on(cache_key, TodoEntry, list_id=list_id)
+
+        entries = await TodoEntry.select_within(
+            TodoList, TodoList.list_id == list_id, columns=ENTRY_COLUMNS, **page
+        )
 
-        return entries
+        if entries:
+            next_page(request, response, len(entries), limit, entries[-1]["entry_id"])
+
+        return json_response(response, entries)
 
     @app.post(
         "/lists/{list_id}/entries",
@@ -180,42 +371,84 @@ def todo_svc() -> FastAPI:
     )
     async def post_todo_entries(list_id: str, create_todo_entry: CreateTodoEntry):
         entry_id = token_hex(2)
-        await TodoList.get(TodoList.list_id == list_id)
-        await TodoEntry.create(
+        await TodoEntry.create_within(
+            TodoList,
+            TodoList.list_id == list_id,
             list_id=list_id,
             entry_id=entry_id,
             text=create_todo_entry.text,
         )
         return f"/lists/{list_id}/entries/{entry_id}"
 
+    @app.post(
+        "/lists/{list_id}/entries/lookup",
+        dependencies=[todo_list_role()],
+    )
+    async def lookup_todo_entries(
+        list_id: str,
+        entry_ids: List[str],
+        response: responses.Response,
+        cache_key: CacheKey = cache.vary_on("x-role", "repr-digest"),
+    ):
+        # a read with a body; CacheMiddleware keys it by Repr-Digest of the requested ids
+        cache.drop_on(cache_key, TodoList, list_id=list_id)
+        cache.drop_on(cache_key, TodoEntry, list_id=list_id)
+
+        entries = await TodoEntry.select_within(
+            TodoList,
+            TodoList.list_id == list_id,
+            columns=ENTRY_COLUMNS,
+            filter=[TodoEntry.entry_id.in_(entry_ids)],
+            order_by=(TodoEntry.entry_id,),
+        )
+
+        return json_response(response, entries)
+
     @app.get(
         "/lists/{list_id}/entries/{entry_id}",
         dependencies=[todo_list_role()],
     )
-    async def get_todo_entry(list_id: str, entry_id: str):
-        area = await TodoEntry.get(TodoEntry.list_id == list_id, TodoEntry.entry_id == entry_id)
+    async def get_todo_entry(
+        list_id: str,
+        entry_id: str,
+        response: responses.Response,
+        cache_key: CacheKey = cache.vary_on("x-role"),
+    ):
+        cache.drop_on(cache_key, TodoList, list_id=list_id)
+        cache.drop_on(cache_key, TodoEntry, list_id=list_id, entry_id=entry_id)
+
+        entry = await TodoEntry.get(
+            TodoEntry.list_id == list_id, TodoEntry.entry_id == entry_id, columns=ENTRY_COLUMNS
+        )
 
-        return area
+        return json_response(response, entry)
 
     @app.patch(
         "/lists/{list_id}/entries/{entry_id}",
         response_class=responses.RedirectResponse,
         status_code=status.HTTP_303_SEE_OTHER,
-        dependencies=[todo_list_role()],
+        dependencies=[todo_list_role(), cache.if_match(current_todo_entry)],
     )
-    async def patch_todo_entry(list_id: str, entry_id: str, update_todo_entry: UpdateTodoEntry):
-        await TodoEntry.update(
+    async def patch_todo_entry(
+        request: Request, list_id: str, entry_id: str, update_todo_entry: UpdateTodoEntry
+    ):
+        entries = await TodoEntry.update(
             TodoEntry.list_id == list_id,
             TodoEntry.entry_id == entry_id,
             **update_todo_entry.dict(exclude_none=True),
         )
 
+        # RETURNING already has all columns of the entry, no need to read it again
+        if entries and prefers_representation(request):
+            entry = {column.key: entries[0][column.key] for column in ENTRY_COLUMNS}
+            return representation(request, entry, "x-role")
+
         return f"/lists/{list_id}/entries/{entry_id}"
 
     @app.delete(
         "/lists/{list_id}/entries/{entry_id}",
         status_code=status.HTTP_204_NO_CONTENT,
-        dependencies=[todo_list_role()],
+        dependencies=[todo_list_role(), cache.if_match(current_todo_entry)],
     )
     async def delete_todo_entry(list_id: str, entry_id: str):
         return await TodoEntry.delete(TodoEntry.list_id == list_id, TodoEntry.entry_id == entry_id)
@@ -224,4 +457,8 @@ def todo_svc() -> FastAPI:
     async def get_health():
         return "OK"
 
+    @app.get("/metrics")
+    async def get_metrics():
+        return responses.Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
     return app
@@ -0,0 +1 @@
+../../common/response.py
\ No newline at end of file
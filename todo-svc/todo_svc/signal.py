@@ -0,0 +1 @@
+../../common/signal.py
\ No newline at end of file